@@ -0,0 +1,496 @@
+from datetime import datetime, timedelta
+from datetime import timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import cv2
+import http.client
+import json
+import logging
+import numpy
+import os
+import platform
+import shutil
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from catalog import parse_image_filename, parse_video_filename
+from recordings_index import RecordingsIndex
+from storage import Storage
+from timelapse_builder import TimelapseBuilder
+from timelapse_camera import TimelapseCamera
+
+
+_REPO_PATH = os.path.dirname(os.path.abspath(__file__))
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    snapshot = None
+
+    def do_GET(self):
+        if self.path.startswith("/snap") or self.path.endswith("/snapshot.jpg"):
+            self._send(200, "image/jpeg", self.snapshot)
+        elif self.path.startswith("/api/events"):
+            self._send(200, "application/json", b"[]")
+        else:
+            self._send(404, "text/plain", b"Not found")
+
+    def _send(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Benchmark(object):
+    def __init__(self, logger, args):
+        self._logger = logger
+        self._args = args
+        self._workspace = tempfile.mkdtemp(prefix="nvr-benchmark-")
+        self._sources = []
+        self._stub_server = None
+        self._server_process = None
+        self._server_port = None
+
+    def run(self):
+        results = {
+            "commit": _git_commit(),
+            "timestamp": datetime.now(tz=timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "results": {},
+        }
+        try:
+            if "recordings" in self._args.only:
+                results["results"]["recordings_index"] = self._benchmark_recordings_index()
+            if "timelapse" in self._args.only:
+                results["results"]["timelapse"] = self._benchmark_timelapse()
+            if len(set(self._args.only) & {"render", "mjpeg", "capture"}) > 0:
+                if shutil.which("ffmpeg") is None:
+                    results["results"]["server"] = {"skipped": "ffmpeg not found"}
+                else:
+                    results["results"]["server"] = self._benchmark_server()
+        finally:
+            self._stop()
+            shutil.rmtree(self._workspace, ignore_errors=True)
+        return results
+
+    def _benchmark_recordings_index(self):
+        results = []
+        for size in self._args.sizes:
+            path = f"{self._workspace}/index_{size}/"
+            video_storage = Storage(self._logger, f"{path}videos/", self._args.layout, parse_video_filename)
+            image_storage = Storage(self._logger, f"{path}images/", self._args.layout, parse_image_filename)
+            start = time.time()
+            _generate_recordings(video_storage, image_storage, size, "bench0")
+            generate_seconds = time.time() - start
+
+            recordings_index = RecordingsIndex(self._logger, video_storage, image_storage)
+            start = time.time()
+            recordings_index.reconcile()
+            scan_seconds = time.time() - start
+            open(video_storage.prepare_path("20300101_000000_bench0.mp4"), "wb").close()
+            start = time.time()
+            recordings_index.reconcile()
+            rescan_seconds = time.time() - start
+            map_seconds = []
+            for i in range(3):
+                start = time.time()
+                recordings = recordings_index.get_mapped_recordings()
+                map_seconds.append(time.time() - start)
+            result = {
+                "files": size,
+                "layout": self._args.layout,
+                "generate_seconds": round(generate_seconds, 3),
+                "scan_seconds": round(scan_seconds, 3),
+                "rescan_one_added_seconds": round(rescan_seconds, 4),
+                "get_mapped_recordings_seconds": round(min(map_seconds), 4),
+                "recordings": len(recordings[0]),
+            }
+            self._logger.info(f"Recordings index: {result}")
+            results.append(result)
+            shutil.rmtree(path, ignore_errors=True)
+        return results
+
+    def _benchmark_timelapse(self):
+        if shutil.which("ffmpeg") is None:
+            return {"skipped": "ffmpeg not found"}
+        path = f"{self._workspace}/timelapse/"
+        video_path = f"{path}videos/"
+        image_path = f"{path}images/"
+        os.makedirs(video_path)
+        os.makedirs(image_path)
+
+        yesterday = (datetime.now(tz=timezone.utc) - timedelta(days=1)).date()
+        last_day = yesterday - timedelta(days=1)
+        if last_day.year != yesterday.year:
+            return {"skipped": "incremental build cannot be measured across the year boundary"}
+        first_day = max(last_day - timedelta(days=self._args.timelapse_days - 1), last_day.replace(month=1, day=1))
+        days = (last_day - first_day).days + 1
+        hours = self._args.timelapse_hours
+        for day in range(days):
+            self._write_timelapse_images(image_path, first_day + timedelta(days=day), hours)
+
+        timelapse_cameras = {
+            "bench0": TimelapseCamera(
+                self._logger, "bench0", None, self._args.timelapse_ffmpeg_options, video_path, image_path,
+                hours, _NullFileManager(), None, None, None, None,
+            )
+        }
+        timelapse_builder = TimelapseBuilder(self._logger, timelapse_cameras, image_path, self._args.timelapse_workers)
+        start = time.time()
+        timelapse_builder.build()
+        full_seconds = time.time() - start
+
+        new_images = self._write_timelapse_images(image_path, yesterday, hours)
+        start = time.time()
+        timelapse_builder.build()
+        incremental_seconds = time.time() - start
+
+        for image in new_images:
+            manifest_file = f"{video_path}incremental/{yesterday.year}_{image[16:18]}_bench0.json"
+            try:
+                with open(manifest_file, "r") as f:
+                    last_image = json.load(f)["last_image"]
+            except (FileNotFoundError, KeyError, ValueError):
+                last_image = None
+            if last_image != image:
+                self._logger.error(f"Incremental timelapse build did not append {image}, manifest has {last_image}")
+                return {"error": f"incremental build did not append {image}"}
+
+        result = {
+            "days": days,
+            "slots": len(hours),
+            "workers": self._args.timelapse_workers,
+            "full_build_seconds": round(full_seconds, 2),
+            "incremental_build_seconds": round(incremental_seconds, 2),
+        }
+        self._logger.info(f"Timelapse: {result}")
+        return result
+
+    def _write_timelapse_images(self, image_path, day, hours):
+        date = day.strftime("%Y%m%d")
+        jpeg = _create_test_jpeg(1280, 720, date)
+        images = []
+        for hour in hours:
+            image = f"{date}_{hour:02}0000_{hour:02}_bench0.jpeg"
+            with open(f"{image_path}{image}", "wb") as f:
+                f.write(jpeg)
+            images.append(image)
+        return images
+
+    def _benchmark_server(self):
+        self._start_stub()
+        self._start_server()
+        results = {"startup_seconds": self._startup_seconds}
+        if "render" in self._args.only:
+            results["recordings_render"] = self._benchmark_render()
+        if "mjpeg" in self._args.only:
+            results["mjpeg"] = self._benchmark_mjpeg()
+        if "capture" in self._args.only:
+            results["capture"] = self._benchmark_capture()
+        return results
+
+    def _benchmark_render(self):
+        seconds = []
+        for i in range(3):
+            start = time.time()
+            with urllib.request.urlopen(f"http://127.0.0.1:{self._server_port}/recordings?full=1") as response:
+                body = response.read()
+            seconds.append(time.time() - start)
+        result = {
+            "files": self._args.render_files,
+            "seconds": round(min(seconds), 4),
+            "bytes": len(body),
+        }
+        self._logger.info(f"Recordings render: {result}")
+        return result
+
+    def _benchmark_mjpeg(self):
+        self._read_mjpeg(1, self._args.warmup)
+        results = []
+        for viewers in self._args.viewers:
+            clients = [None] * viewers
+            threads = [
+                threading.Thread(target=lambda i=i: clients.__setitem__(i, self._read_mjpeg(i, self._args.duration)))
+                for i in range(viewers)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            clients = [client for client in clients if client is not None]
+            intervals = sorted([interval for client in clients for interval in client["intervals"]])
+            result = {
+                "viewers": viewers,
+                "connected": len(clients),
+                "fps_per_client": round(statistics.mean([client["frames"] for client in clients]) / self._args.duration, 2) if clients else 0,
+                "total_fps": round(sum([client["frames"] for client in clients]) / self._args.duration, 2),
+                "bytes_per_second": round(sum([client["bytes"] for client in clients]) / self._args.duration),
+                "first_frame_p50_seconds": _percentile(sorted([client["first_frame"] for client in clients]), 50),
+                "frame_interval_p50_seconds": _percentile(intervals, 50),
+                "frame_interval_p95_seconds": _percentile(intervals, 95),
+            }
+            self._logger.info(f"MJPEG: {result}")
+            results.append(result)
+        return results
+
+    def _read_mjpeg(self, client, duration):
+        try:
+            start = time.time()
+            connection = http.client.HTTPConnection("127.0.0.1", self._server_port, timeout=30)
+            connection.request("GET", f"/cameras/bench0/stream/mjpeg{self._args.mjpeg_query}")
+            response = connection.getresponse()
+            if response.status != 200:
+                self._logger.warning(f"MJPEG client {client} got {response.status}")
+                return None
+            frame_times = []
+            received = 0
+            tail = b""
+            while time.time() - start < duration:
+                chunk = response.read1(65536)
+                if not chunk:
+                    break
+                received = received + len(chunk)
+                data = tail + chunk
+                now = time.time()
+                frame_times.extend([now] * data.count(b"--frame\r\n"))
+                tail = data[-8:]
+            connection.close()
+        except Exception as err:
+            self._logger.warning(f"MJPEG client {client} failed: {err}")
+            return None
+        return {
+            "frames": len(frame_times),
+            "bytes": received,
+            "first_frame": frame_times[0] - start if frame_times else None,
+            "intervals": [b - a for a, b in zip(frame_times, frame_times[1:])],
+        }
+
+    def _benchmark_capture(self):
+        storage = Storage(self._logger, f"{self._workspace}/server/videos/", self._args.layout, parse_video_filename)
+        results = []
+        for i in range(self._args.captures):
+            before = storage.list_files()
+            start = time.time()
+            urllib.request.urlopen(f"http://127.0.0.1:{self._server_port}/cameras/bench0/capture/start").read()
+            time.sleep(self._args.capture_seconds)
+            end = time.time()
+            urllib.request.urlopen(f"http://127.0.0.1:{self._server_port}/cameras/bench0/capture/end").read()
+            video_file = None
+            while video_file is None and time.time() - end < 60:
+                added = [file for file in storage.list_files() - before if file.endswith(".mp4")]
+                if len(added) > 0:
+                    video_file = added[0]
+                else:
+                    time.sleep(0.05)
+            if video_file is None:
+                results.append({"error": "no video produced"})
+                continue
+            available = time.time()
+            duration = _probe_duration(storage.get_path(video_file))
+            result = {
+                "start_request_seconds": round(end - start - self._args.capture_seconds, 4),
+                "end_to_file_seconds": round(available - end, 3),
+                "duration_seconds": duration,
+                "preroll_seconds": round(duration - (end - start), 2) if duration is not None else None,
+            }
+            self._logger.info(f"Capture: {result}")
+            results.append(result)
+            time.sleep(2)
+        return results
+
+    def _start_stub(self):
+        _StubHandler.snapshot = _create_test_jpeg(1280, 720, "snapshot")
+        self._stub_server = ThreadingHTTPServer(("127.0.0.1", 0), _StubHandler)
+        threading.Thread(target=self._stub_server.serve_forever, daemon=True).start()
+
+    def _start_source(self, name):
+        port = _free_port()
+        command = (
+            f"while true; do ffmpeg -loglevel error -nostats -re -f lavfi -i testsrc2=size=640x360:rate=10 "
+            f"-c:v libx264 -preset ultrafast -tune zerolatency -g 20 -f mpegts -listen 1 "
+            f"http://127.0.0.1:{port}/{name}.ts; sleep 1; done"
+        )
+        self._sources.append(subprocess.Popen(["sh", "-c", command], preexec_fn=os.setsid))
+        return f"http://127.0.0.1:{port}/{name}.ts"
+
+    def _start_server(self):
+        server_path = f"{self._workspace}/server/"
+        os.makedirs(server_path)
+        with open(f"{_REPO_PATH}/config.json", "r") as f:
+            config = json.load(f)
+        for key in [
+            "video_file_path", "image_file_path", "timelapse_video_file_path", "timelapse_image_file_path",
+            "temp_video_file_path", "segment_buffer_path", "thumbnail_file_path", "frigate_snapshot_cache_path",
+        ]:
+            config[key] = f"{server_path}{key}/"
+            os.makedirs(config[key], exist_ok=True)
+        config["catalog_file"] = f"{server_path}catalog.sqlite3"
+        stub_url = f"http://127.0.0.1:{self._stub_server.server_address[1]}"
+        config["frigate_base_url"] = stub_url
+        self._server_port = _free_port()
+        config["server"]["host"] = "127.0.0.1"
+        config["server"]["port"] = self._server_port
+
+        camera_config = config["cameras"][0]
+        camera_config["name"] = "bench0"
+        camera_config["display_name"] = "Benchmark"
+        camera_config["capture"]["url"] = self._start_source("capture")
+        camera_config["capture"]["image_url"] = f"{stub_url}/snap"
+        camera_config["stream"]["url"] = self._start_source("stream")
+        camera_config["stream"]["idle_timeout"] = 0
+        camera_config["timelapse"]["image_url"] = f"{stub_url}/snap"
+        camera_config["motion"]["enabled"] = False
+        config["storage_layout"] = self._args.layout
+        config["cameras"] = [camera_config]
+
+        with open(f"{server_path}config.json", "w") as f:
+            json.dump(config, f, indent=2)
+        with open(f"{server_path}secrets.json", "w") as f:
+            json.dump({}, f)
+        if "render" in self._args.only:
+            _generate_recordings(
+                Storage(self._logger, config["video_file_path"], self._args.layout, parse_video_filename),
+                Storage(self._logger, config["image_file_path"], self._args.layout, parse_image_filename),
+                self._args.render_files,
+                "bench0",
+            )
+
+        start = time.time()
+        self._server_log = open(f"{server_path}server.log", "w")
+        self._server_process = subprocess.Popen(
+            [sys.executable, f"{_REPO_PATH}/nvr_server.py"],
+            cwd=server_path,
+            stdout=self._server_log,
+            stderr=subprocess.STDOUT,
+        )
+        while True:
+            try:
+                urllib.request.urlopen(f"http://127.0.0.1:{self._server_port}/recordings/lastchanged").read()
+                break
+            except Exception:
+                if self._server_process.poll() is not None or time.time() - start > 120:
+                    raise Exception(f"Server failed to start, see {server_path}server.log")
+                time.sleep(0.1)
+        self._startup_seconds = round(time.time() - start, 2)
+        self._logger.info(f"Server started in {self._startup_seconds}s on port {self._server_port}")
+
+    def _stop(self):
+        if self._server_process is not None:
+            self._server_process.send_signal(signal.SIGTERM)
+            try:
+                self._server_process.wait(30)
+            except subprocess.TimeoutExpired:
+                self._server_process.kill()
+            self._server_log.close()
+        for source in self._sources:
+            try:
+                os.killpg(os.getpgid(source.pid), signal.SIGTERM)
+            except Exception:
+                pass
+        if self._stub_server is not None:
+            self._stub_server.shutdown()
+
+
+class _NullFileManager(object):
+    def add_timelapse(self, timelapse_file):
+        pass
+
+
+def _generate_recordings(video_storage, image_storage, count, camera_name):
+    os.makedirs(video_storage.get_root(), exist_ok=True)
+    os.makedirs(image_storage.get_root(), exist_ok=True)
+    start = datetime(2024, 1, 1)
+    for i in range(count // 3):
+        first_timestamp = (start + timedelta(minutes=5 * i)).strftime("%Y%m%d_%H%M%S")
+        open(video_storage.prepare_path(f"{first_timestamp}_{camera_name}.mp4"), "wb").close()
+        for j in range(2):
+            event_timestamp = (start + timedelta(minutes=5 * i, seconds=10 * j)).strftime("%Y%m%d_%H%M%S")
+            open(image_storage.prepare_path(f"{first_timestamp}_{event_timestamp}_{camera_name}.jpeg"), "wb").close()
+
+
+def _create_test_jpeg(width, height, text):
+    image = numpy.zeros((height, width, 3), numpy.uint8)
+    image[:, :, 0] = numpy.linspace(0, 255, width, dtype=numpy.uint8)
+    image[:, :, 1] = numpy.linspace(0, 255, height, dtype=numpy.uint8)[:, None]
+    cv2.putText(image, text, (40, height // 2), cv2.FONT_HERSHEY_SIMPLEX, 2, (255, 255, 255), 3)
+    return bytes(cv2.imencode(".jpeg", image, [cv2.IMWRITE_JPEG_QUALITY, 85])[1])
+
+
+def _probe_duration(filename):
+    try:
+        output = subprocess.run(
+            ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "default=noprint_wrappers=1:nokey=1", filename],
+            stdout=subprocess.PIPE,
+            timeout=30,
+        ).stdout
+        return round(float(output.decode().strip()), 2)
+    except Exception:
+        return None
+
+
+def _percentile(values, percentile):
+    values = [value for value in values if value is not None]
+    if len(values) == 0:
+        return None
+    return round(values[min(len(values) - 1, int(len(values) * percentile / 100))], 4)
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=_REPO_PATH, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        ).stdout.decode().strip() or None
+    except Exception:
+        return None
+
+
+def _int_list(value):
+    return [int(item) for item in value.split(",")]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s in %(module)s: %(message)s")
+    logger = logging.getLogger(__name__)
+
+    parser = argparse.ArgumentParser(description="Run the NVR benchmarks against synthetic cameras")
+    parser.add_argument("--output", default=None, help="JSON result file, default benchmark-<commit>.json")
+    parser.add_argument("--only", default="recordings,timelapse,render,mjpeg,capture", type=lambda x: x.split(","))
+    parser.add_argument("--sizes", default="10000,100000,500000", type=_int_list, help="Recording file counts")
+    parser.add_argument("--render-files", default=10000, type=int)
+    parser.add_argument("--layout", default="flat", choices=["flat", "sharded"], help="Storage layout for generated recordings")
+    parser.add_argument("--viewers", default="1,5,25,100", type=_int_list)
+    parser.add_argument("--mjpeg-query", default="", help="Query string for the MJPEG URL, e.g. ?width=320&fps=5")
+    parser.add_argument("--duration", default=10, type=float, help="Seconds per MJPEG step")
+    parser.add_argument("--warmup", default=5, type=float)
+    parser.add_argument("--captures", default=3, type=int)
+    parser.add_argument("--capture-seconds", default=5, type=float)
+    parser.add_argument("--timelapse-days", default=365, type=int, help="Days of frames ending the day before yesterday, clipped to the current year")
+    parser.add_argument("--timelapse-hours", default="3,7,11,15,19", type=_int_list)
+    parser.add_argument("--timelapse-workers", default=2, type=int)
+    parser.add_argument("--timelapse-ffmpeg-options", default="-c:v libx264 -preset slow -crf 30 -vf scale=1920:1080")
+    args = parser.parse_args()
+
+    results = Benchmark(logger, args).run()
+    output = args.output or f"benchmark-{(results['commit'] or 'unknown')[:12]}.json"
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    logger.info(f"Wrote benchmark results to {output}")
@@ -1,9 +1,8 @@
 import threading
 import time
-import subprocess, io
-import signal
+import subprocess
 import os
-import utils
+from metrics import metrics
 
 
 class CaptureCamera(object):
@@ -11,73 +10,76 @@ class CaptureCamera(object):
         self,
         logger,
         camera_name,
-        camera_url,
         camera_image_url,
         ffmpeg_options,
-        video_file_path,
-        image_file_path,
+        video_storage,
+        image_storage,
         temp_file_path,
         capture_timeout,
+        file_manager,
+        segment_buffer,
+        preroll_seconds,
+        snapshot_fetcher,
+        stream_camera,
+        image_width,
+        image_quality,
     ):
         self._logger = logger
         self._camera_name = camera_name
-        self._camera_url = camera_url
         self._camera_image_url = camera_image_url
         self._ffmpeg_options = ffmpeg_options
-        self._video_file_path = video_file_path
-        self._image_file_path = image_file_path
+        self._video_storage = video_storage
+        self._image_storage = image_storage
         self._temp_file_path = temp_file_path
         self._capture_timeout = capture_timeout
-        self._capture_video_process = None
+        self._file_manager = file_manager
+        self._segment_buffer = segment_buffer
+        self._preroll_seconds = preroll_seconds
+        self._snapshot_fetcher = snapshot_fetcher
+        self._stream_camera = stream_camera
+        self._image_width = image_width
+        self._image_quality = image_quality
+        self._lock = threading.Lock()
+        self._capture_id = 0
+        self._capture_hold = None
+        self._capture_since = None
+        self._capture_timer = None
         self._event_timestamp = None
         self._first_event_timestamp = None
         self._capturing = False
 
-    def _capture_video(self):
-        start = time.time()
-        rtsp_options = ""
-        if self._camera_url.startswith("rtsp"):
-            rtsp_options = "-rtsp_transport tcp"
-
-        command = f'ffmpeg -loglevel warning -nostats -y {rtsp_options} -i "{self._camera_url}" -t {self._capture_timeout} -metadata title="" {self._ffmpeg_options} {self._temp_file_path}{self._camera_name}_tmp.mp4'
-        self._logger.info(
-            f"Launching capture video process for {self._camera_name}: {command}"
-        )
-        self._capture_video_process = subprocess.Popen(
-            command,
-            shell=True,
-            stdout=subprocess.PIPE,
-            bufsize=-1,
-            preexec_fn=os.setsid,
-        )
-        output = io.TextIOWrapper(self._capture_video_process.stdout)
-        self._capture_video_process.wait()
-        output
-        elapsed = time.time() - start
-        self._logger.info(
-            f"Capture video process for {self._camera_name} done in {elapsed:.1f}s"
-        )
-        self._capture_video_process = None
-        if self._capturing:
-            self._logger.info(f"Capture video process timed out for {self._camera_name}")
-            self.capture_end()
+    def _capture_timed_out(self, capture_id):
+        if capture_id != self._capture_id:
+            return
+        self._logger.info(f"Capture timed out for {self._camera_name}")
+        self.capture_end()
 
     def _capture_image(self):
-        filename = f"{self._first_event_timestamp}_{self._event_timestamp}_{self._camera_name}"
-        start = time.time()
-        utils.urlopen_to_file(self._logger, self._camera_image_url, f"{self._image_file_path}{filename}.jpeg", 8)
-        elapsed = time.time() - start
-        self._logger.info(
-            f"Capture image done for {self._camera_name} in {elapsed:.1f}s"
+        filename = f"{self._first_event_timestamp}_{self._event_timestamp}_{self._camera_name}.jpeg"
+        self._snapshot_fetcher.fetch(
+            self._camera_name,
+            self._camera_image_url,
+            self._image_storage.prepare_path(filename),
+            lambda file: self._file_manager.add_image(filename),
+            self._stream_camera,
+            self._image_width,
+            self._image_quality,
         )
 
     def capture_start(self):
-        if self._capturing:
-            return
-        self._capturing = True
-        video_thread = threading.Thread(target=self._capture_video, args=(), kwargs={})
-
-        video_thread.start()
+        with self._lock:
+            if self._capturing:
+                return
+            self._capturing = True
+            self._capture_id = self._capture_id + 1
+            self._capture_since = time.time() - self._preroll_seconds
+            self._capture_hold = self._segment_buffer.hold(self._capture_since)
+            self._capture_timer = threading.Timer(
+                self._capture_timeout, self._capture_timed_out, args=(self._capture_id,)
+            )
+            self._capture_timer.daemon = True
+            self._capture_timer.start()
+        self._logger.info(f"Capture started for {self._camera_name}")
 
     def capture_keep(self, timestamp):
         if not self._capturing:
@@ -85,35 +87,78 @@ class CaptureCamera(object):
         if self._first_event_timestamp is None:
             self._first_event_timestamp = timestamp
         self._event_timestamp = timestamp
-        image_thread = threading.Thread(target=self._capture_image, args=(), kwargs={})
-        image_thread.start()
+        self._capture_image()
 
     def capture_end(self):
-        if not self._capturing:
+        with self._lock:
+            if not self._capturing:
+                return
+            self._capturing = False
+            self._capture_id = self._capture_id + 1
+            self._capture_timer.cancel()
+            until = time.time()
+            hold_id = self._capture_hold
+            since = self._capture_since
+            first_event_timestamp = self._first_event_timestamp
+            self._capture_hold = None
+            self._event_timestamp = None
+            self._first_event_timestamp = None
+
+        if first_event_timestamp is None:
+            self._logger.info(f"Discarding capture for {self._camera_name}")
+            self._segment_buffer.release(hold_id)
             return
-        self._capturing = False
 
-        pgid = None
+        self._logger.info(
+            f"Keeping capture ({first_event_timestamp}) for {self._camera_name}"
+        )
+        keep_thread = threading.Thread(
+            target=self._keep_video,
+            args=(hold_id, since, until, f"{first_event_timestamp}_{self._camera_name}.mp4"),
+        )
+        keep_thread.start()
+
+    def _keep_video(self, hold_id, since, until, filename):
+        start = time.time()
+        segments = []
+        try:
+            self._segment_buffer.wait_for(until)
+            segments = self._segment_buffer.get_segments(since, until)
+            if len(segments) == 0:
+                self._logger.error(f"No recorded segments for capture ({filename})")
+            elif self._concat(segments, filename):
+                self._file_manager.add_video(filename)
+        finally:
+            self._segment_buffer.release(hold_id)
+        elapsed = time.time() - start
+        self._logger.info(
+            f"Capture video from {len(segments)} segments done for {self._camera_name} in {elapsed:.1f}s"
+        )
+
+    def _concat(self, segments, filename):
+        prefix = f"{self._temp_file_path}{os.path.splitext(filename)[0]}"
+        list_file = f"{prefix}.txt"
+        temp_file = f"{prefix}_tmp.mp4"
         try:
-            pgid = os.getpgid(self._capture_video_process.pid)
-        except Exception:
-            self._logger.info(f"No running video process for {self._camera_name}")
-        if pgid is not None:
-            self._logger.info(f"Terminating video process for {self._camera_name}")
-            os.killpg(pgid, signal.SIGTERM)
-        
-        temp_file = f"{self._temp_file_path}{self._camera_name}_tmp.mp4"
-        if not os.path.isfile(temp_file):
-            self._logger.error(f"No capture output produced ({self._first_event_timestamp}) for {self._camera_name}")
-        elif self._first_event_timestamp is not None:
-            self._logger.info(
-                f"Keeping captured video file ({self._first_event_timestamp}) for {self._camera_name}"
-            )
-            filename = f"{self._video_file_path}{self._first_event_timestamp}_{self._camera_name}.mp4"
-            os.rename(temp_file, filename)
-            
-            self._event_timestamp = None
-            self._first_event_timestamp = None
-        else:
-            self._logger.info(f"Discarding captured video file for {self._camera_name}")
-            os.remove(temp_file)
+            with open(list_file, "w") as f:
+                for segment_start, segment_end, segment in segments:
+                    f.write(f"file '{os.path.abspath(segment)}'\n")
+            start = time.time()
+            returncode = subprocess.run(
+                f'ffmpeg -loglevel error -nostats -y -f concat -safe 0 -i {list_file} -map 0 -metadata title="" {self._ffmpeg_options} {temp_file}',
+                shell=True,
+            ).returncode
+            labels = {"camera": self._camera_name, "job": "capture"}
+            metrics.observe("nvr_ffmpeg_seconds", labels, time.time() - start)
+            metrics.inc("nvr_ffmpeg_exits_total", dict(labels, code=returncode))
+            if returncode != 0:
+                raise Exception(f"ffmpeg exited with {returncode}")
+            os.rename(temp_file, self._video_storage.prepare_path(filename))
+            return True
+        except Exception as err:
+            self._logger.error(f"Failed to write captured video ({filename}) for {self._camera_name}: {err}")
+            return False
+        finally:
+            for file in [list_file, temp_file]:
+                if os.path.isfile(file):
+                    os.remove(file)
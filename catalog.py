@@ -0,0 +1,303 @@
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import utils
+import wsgi_server
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS videos (
+    filename TEXT PRIMARY KEY,
+    camera TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    duration REAL
+);
+CREATE INDEX IF NOT EXISTS videos_camera_timestamp ON videos (camera, timestamp);
+CREATE INDEX IF NOT EXISTS videos_timestamp ON videos (timestamp);
+
+CREATE TABLE IF NOT EXISTS images (
+    filename TEXT PRIMARY KEY,
+    camera TEXT NOT NULL,
+    event_timestamp TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS images_camera_event_timestamp ON images (camera, event_timestamp);
+CREATE INDEX IF NOT EXISTS images_timestamp ON images (timestamp);
+
+CREATE TABLE IF NOT EXISTS timelapses (
+    filename TEXT PRIMARY KEY,
+    camera TEXT NOT NULL,
+    year INTEGER NOT NULL,
+    hour INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    duration REAL
+);
+CREATE INDEX IF NOT EXISTS timelapses_camera_year ON timelapses (camera, year);
+"""
+
+
+def parse_video_filename(filename):
+    if not filename.endswith(".mp4") or filename.endswith("_tmp.mp4") or len(filename) < 21:
+        return None
+    return filename[0:15], os.path.splitext(filename)[0][16:]
+
+
+def parse_image_filename(filename):
+    if not filename.endswith(".jpeg") or len(filename) < 38:
+        return None
+    return filename[0:15], filename[16:31], os.path.splitext(filename)[0][32:]
+
+
+def parse_timelapse_filename(filename):
+    if not filename.endswith(".mp4") or len(filename) < 13:
+        return None
+    filename_no_ext = os.path.splitext(filename)[0]
+    if not filename_no_ext[0:4].isdigit() or not filename_no_ext[5:7].isdigit():
+        return None
+    return int(filename_no_ext[0:4]), int(filename_no_ext[5:7]), filename_no_ext[8:]
+
+
+def _filter(query, camera_column, timestamp_column, camera, since, until):
+    params = []
+    if camera is not None:
+        query += f" AND {camera_column} = ?"
+        params.append(camera)
+    if since is not None:
+        query += f" AND {timestamp_column} >= ?"
+        params.append(since)
+    if until is not None:
+        query += f" AND {timestamp_column} < ?"
+        params.append(until)
+    return query, params
+
+class Catalog(object):
+    def __init__(self, logger, database_file):
+        self._logger = logger
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(database_file, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        with self._connection:
+            self._connection.executescript(_SCHEMA)
+
+    def _read(self, query, params=()):
+        with self._lock:
+            return wsgi_server.offload(lambda: self._connection.execute(query, params).fetchall())
+
+    def _write(self, func, *args):
+        with self._lock:
+            return wsgi_server.offload(self._transaction, func, *args)
+
+    def _transaction(self, func, *args):
+        with self._connection:
+            func(*args)
+
+    def is_empty(self):
+        for table in ["videos", "images", "timelapses"]:
+            if len(self._read(f"SELECT 1 FROM {table} LIMIT 1")) > 0:
+                return False
+        return True
+
+    def add_videos(self, videos):
+        self._write(self._insert_videos, videos)
+
+    def add_images(self, images):
+        self._write(self._insert_images, images)
+
+    def add_timelapses(self, timelapses):
+        self._write(self._insert_timelapses, timelapses)
+
+    def _insert_videos(self, videos):
+        rows = []
+        for filename, size, duration in videos:
+            parsed = parse_video_filename(filename)
+            if parsed is not None:
+                rows.append((filename, parsed[1], parsed[0], size, duration))
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO videos (filename, camera, timestamp, size, duration) VALUES (?, ?, ?, ?, ?)",
+            rows,
+        )
+
+    def _insert_images(self, images):
+        rows = []
+        for filename, size in images:
+            parsed = parse_image_filename(filename)
+            if parsed is not None:
+                rows.append((filename, parsed[2], parsed[0], parsed[1], size))
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO images (filename, camera, event_timestamp, timestamp, size) VALUES (?, ?, ?, ?, ?)",
+            rows,
+        )
+
+    def _insert_timelapses(self, timelapses):
+        rows = []
+        for filename, size, duration in timelapses:
+            parsed = parse_timelapse_filename(filename)
+            if parsed is not None:
+                rows.append((filename, parsed[2], parsed[0], parsed[1], size, duration))
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO timelapses (filename, camera, year, hour, size, duration) VALUES (?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+
+    def remove_videos(self, filenames):
+        self._remove("videos", filenames)
+
+    def remove_images(self, filenames):
+        self._remove("images", filenames)
+
+    def remove_timelapses(self, filenames):
+        self._remove("timelapses", filenames)
+
+    def _remove(self, table, filenames):
+        self._write(
+            self._connection.executemany,
+            f"DELETE FROM {table} WHERE filename = ?",
+            [(filename,) for filename in filenames],
+        )
+
+    def get_video_filenames(self):
+        return self._get_filenames("videos")
+
+    def get_image_filenames(self):
+        return self._get_filenames("images")
+
+    def get_timelapse_filenames(self):
+        return self._get_filenames("timelapses")
+
+    def _get_filenames(self, table):
+        return set(row[0] for row in self._read(f"SELECT filename FROM {table}"))
+
+    def get_videos_before(self, timestamp):
+        return self._read("SELECT filename, size FROM videos WHERE timestamp < ? ORDER BY timestamp", (timestamp,))
+
+    def get_images_before(self, timestamp):
+        return self._read(
+            "SELECT filename, size FROM images WHERE event_timestamp < ? ORDER BY event_timestamp", (timestamp,)
+        )
+
+    def get_timelapses_before(self, year):
+        return self._read("SELECT filename, size FROM timelapses WHERE year < ? ORDER BY year", (year,))
+
+    def get_oldest_videos(self, limit, camera=None):
+        return self._get_oldest("videos", "timestamp", limit, camera)
+
+    def get_oldest_images(self, limit, camera=None):
+        return self._get_oldest("images", "event_timestamp", limit, camera)
+
+    def _get_oldest(self, table, timestamp_column, limit, camera):
+        query = f"SELECT filename, size, {timestamp_column} FROM {table}"
+        params = []
+        if camera is not None:
+            query += " WHERE camera = ?"
+            params.append(camera)
+        query += f" ORDER BY {timestamp_column} LIMIT ?"
+        params.append(limit)
+        return self._read(query, params)
+
+    def get_video_usage(self):
+        return self._get_usage("videos")
+
+    def get_image_usage(self):
+        return self._get_usage("images")
+
+    def _get_usage(self, table):
+        return dict(self._read(f"SELECT camera, SUM(size) FROM {table} GROUP BY camera"))
+
+    def get_videos(self, camera=None, since=None, until=None):
+        query, params = _filter(
+            "SELECT v.filename, v.camera, v.timestamp, v.size, v.duration, i.filename FROM videos v"
+            " LEFT JOIN images i ON i.camera = v.camera AND i.event_timestamp = v.timestamp WHERE 1 = 1",
+            "v.camera",
+            "v.timestamp",
+            camera,
+            since,
+            until,
+        )
+        videos = []
+        for row in self._read(f"{query} ORDER BY v.filename DESC, i.filename", params):
+            if len(videos) == 0 or videos[-1]["filename"] != row[0]:
+                videos.append({
+                    "filename": row[0],
+                    "camera_name": row[1],
+                    "timestamp": row[2],
+                    "size": row[3],
+                    "duration": row[4],
+                    "images": [],
+                })
+            if row[5] is not None:
+                videos[-1]["images"].append(row[5])
+        return videos
+
+    def get_orphan_images(self, camera=None, since=None, until=None):
+        query, params = _filter(
+            "SELECT i.filename FROM images i WHERE NOT EXISTS"
+            " (SELECT 1 FROM videos v WHERE v.camera = i.camera AND v.timestamp = i.event_timestamp)",
+            "i.camera",
+            "i.event_timestamp",
+            camera,
+            since,
+            until,
+        )
+        return [row[0] for row in self._read(f"{query} ORDER BY i.filename DESC", params)]
+
+    def get_timelapses(self):
+        return [
+            {"filename": row[0], "camera_name": row[1], "year": row[2], "hour": row[3], "size": row[4], "duration": row[5]}
+            for row in self._read(
+                "SELECT filename, camera, year, hour, size, duration FROM timelapses ORDER BY filename DESC"
+            )
+        ]
+
+    def _replace_all(self, videos, images, timelapses):
+        for table in ["videos", "images", "timelapses"]:
+            self._connection.execute(f"DELETE FROM {table}")
+        self._insert_videos(videos)
+        self._insert_images(images)
+        self._insert_timelapses(timelapses)
+
+    def import_directories(self, video_storage, image_storage, timelapse_video_file_path, probe_durations=False):
+        self._logger.info("Importing catalog from file directories")
+        videos = [
+            (file, os.path.getsize(video_storage.get_path(file)), utils.probe_duration(self._logger, video_storage.get_path(file)) if probe_durations else None)
+            for file in video_storage.list_files()
+        ]
+        images = [
+            (file, os.path.getsize(image_storage.get_path(file)))
+            for file in image_storage.list_files()
+        ]
+        timelapses = [
+            (file, os.path.getsize(f"{timelapse_video_file_path}{file}"), utils.probe_duration(self._logger, f"{timelapse_video_file_path}{file}") if probe_durations else None)
+            for file in os.listdir(timelapse_video_file_path) if parse_timelapse_filename(file) is not None
+        ]
+        self._write(self._replace_all, videos, images, timelapses)
+        self._logger.info(
+            f"Imported {len(videos)} videos, {len(images)} images and {len(timelapses)} timelapses into catalog"
+        )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s in %(module)s: %(message)s")
+    logger = logging.getLogger(__name__)
+
+    if len(sys.argv) < 2 or sys.argv[1] != "import":
+        print(f"Usage: {sys.argv[0]} import [--probe-durations]")
+        sys.exit(1)
+
+    with open("config.json", "r") as f:
+        config = json.load(f)
+
+    from storage import Storage
+
+    catalog = Catalog(logger, config["catalog_file"])
+    catalog.import_directories(
+        Storage(logger, config["video_file_path"], config["storage_layout"], parse_video_filename),
+        Storage(logger, config["image_file_path"], config["storage_layout"], parse_image_filename),
+        config["timelapse_video_file_path"],
+        "--probe-durations" in sys.argv,
+    )
@@ -1,101 +1,401 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 import os
+import shutil
+import threading
+import time
 import pytz
-from datetime import timezone
+from catalog import parse_image_filename, parse_timelapse_filename, parse_video_filename
+from recordings_index import RecordingsIndex
+from metrics import metrics
+import utils
 
 
 class FileManager(object):
-    def __init__(self, logger, video_file_path, image_file_path, purge_video_days, purge_image_days):
+    def __init__(
+        self,
+        logger,
+        video_storage,
+        image_storage,
+        timelapse_video_file_path,
+        timelapse_image_file_path,
+        purge_video_days,
+        purge_image_days,
+        purge_timelapse_video_days,
+        purge_timelapse_image_days,
+        purge_batch_size,
+        purge_batch_sleep,
+        retention_mode,
+        video_quota_bytes,
+        image_quota_bytes,
+        camera_video_quota_bytes,
+        min_free_bytes,
+        catalog,
+        thumbnail_cache,
+    ):
         self._logger = logger
-        self._video_file_path = video_file_path
-        self._image_file_path = image_file_path
+        self._video_storage = video_storage
+        self._image_storage = image_storage
+        self._timelapse_video_file_path = timelapse_video_file_path
+        self._timelapse_image_file_path = timelapse_image_file_path
         self._purge_video_days = purge_video_days
         self._purge_image_days = purge_image_days
+        self._purge_timelapse_video_days = purge_timelapse_video_days
+        self._purge_timelapse_image_days = purge_timelapse_image_days
+        self._purge_batch_size = purge_batch_size
+        self._purge_batch_sleep = purge_batch_sleep
+        self._retention_mode = retention_mode
+        self._video_quota_bytes = video_quota_bytes
+        self._image_quota_bytes = image_quota_bytes
+        self._camera_video_quota_bytes = camera_video_quota_bytes
+        self._min_free_bytes = min_free_bytes
+        self._purge_thread = None
+        self._catalog = catalog
+        self._thumbnail_cache = thumbnail_cache
+        self._recordings_index = RecordingsIndex(logger, video_storage, image_storage)
+        self._usage_lock = threading.Lock()
+        self._video_usage = {}
+        self._image_usage = {}
+        self._change_condition = threading.Condition()
+        self._change_token = int(time.time() * 1000)
 
-    def get_mapped_recordings(self):
-        image_files = list(filter(lambda x: x.endswith(".jpeg"), os.listdir(self._image_file_path)))
-        image_files.sort(reverse=True)
-        video_files = list(filter(lambda x: x.endswith(".mp4"), os.listdir(self._video_file_path)))
-        video_files.sort(reverse=True)
+        if self._catalog.is_empty():
+            self._catalog.import_directories(video_storage, image_storage, timelapse_video_file_path)
+        self.reconcile()
+        self._load_usage()
 
-        recordings = []
-        for video_file in video_files:
-            timestamp = video_file[0:15]
-            camera_name = os.path.splitext(video_file)[0][16:]
-            matching_image_files = list(
-                filter(lambda x: x.startswith(timestamp) and x.endswith(f"{camera_name}.jpeg"), image_files)
-            )
-            matching_image_files.sort(reverse=False)
-            image_files = [image_file for image_file in image_files if image_file not in matching_image_files]
-
-            image_file = None
-            extra_images = []
-            for matching_image_file in matching_image_files:
-                image_timestamp = matching_image_file[16:31]
-                if image_file is None:
-                    image_file = matching_image_file
-                else:
-                    extra_images.append({
-                        "timestamp": datetime.strptime(image_timestamp, "%Y%m%d_%H%M%S"),
-                        "filename": matching_image_file,
-                    })
+    def get_mapped_recordings(self, camera_name=None, since=None, until=None):
+        if camera_name is None and since is None and until is None:
+            return self._recordings_index.get_mapped_recordings()
 
+        recordings = []
+        for video in self._catalog.get_videos(camera_name, since, until):
             recordings.append({
-                "camera_name": camera_name,
-                "timestamp": datetime.strptime(timestamp, "%Y%m%d_%H%M%S"),
-                "video_filename": video_file,
-                "image_filename": image_file,
-                "extra_images": extra_images,
+                "camera_name": video["camera_name"],
+                "timestamp": datetime.strptime(video["timestamp"], "%Y%m%d_%H%M%S"),
+                "video_filename": video["filename"],
+                "image_filename": video["images"][0] if len(video["images"]) > 0 else None,
+                "extra_images": [
+                    {"timestamp": datetime.strptime(image_file[16:31], "%Y%m%d_%H%M%S"), "filename": image_file}
+                    for image_file in video["images"][1:]
+                ],
             })
+
         orphan_images = []
-        for image_file in image_files:
-            orphan_image = {
-                "camera_name": os.path.splitext(image_file)[0][32:],
+        for image_file in self._catalog.get_orphan_images(camera_name, since, until):
+            orphan_images.append({
+                "camera_name": parse_image_filename(image_file)[2],
                 "timestamp": datetime.strptime(image_file[16:31], "%Y%m%d_%H%M%S"),
                 "image_filename": image_file,
-            }
-            orphan_images.append(orphan_image)
-            
+            })
+
         return recordings, orphan_images
 
-    def remove_old_videos(self):
-        files = list(
-            filter(lambda x: x.endswith(".mp4"), os.listdir(self._video_file_path))
+    def get_timelapses(self):
+        return self._catalog.get_timelapses()
+
+    def add_video(self, video_file):
+        file = self._video_storage.get_path(video_file)
+        size = os.path.getsize(file)
+        self._catalog.add_videos([(video_file, size, utils.probe_duration(self._logger, file))])
+        self._recordings_index.add_video(video_file)
+        self._update_usage("videos", video_file, size)
+        self._changed()
+
+    def add_image(self, image_file):
+        size = os.path.getsize(self._image_storage.get_path(image_file))
+        self._catalog.add_images([(image_file, size)])
+        self._recordings_index.add_image(image_file)
+        self._update_usage("images", image_file, size)
+        self._thumbnail_cache.warm(image_file)
+        self._changed()
+
+    def get_change_token(self):
+        with self._change_condition:
+            return self._change_token
+
+    def wait_for_change(self, change_token, timeout):
+        with self._change_condition:
+            self._change_condition.wait_for(lambda: self._change_token != change_token, timeout)
+            return self._change_token
+
+    def _changed(self):
+        with self._change_condition:
+            self._change_token = self._change_token + 1
+            self._change_condition.notify_all()
+
+    def get_usage(self):
+        with self._usage_lock:
+            return {"videos": dict(self._video_usage), "images": dict(self._image_usage)}
+
+    def _load_usage(self):
+        video_usage = self._catalog.get_video_usage()
+        image_usage = self._catalog.get_image_usage()
+        with self._usage_lock:
+            self._video_usage = video_usage
+            self._image_usage = image_usage
+
+    def _update_usage(self, kind, file, size):
+        if kind == "videos":
+            parsed = parse_video_filename(file)
+            usage = self._video_usage
+        elif kind == "images":
+            parsed = parse_image_filename(file)
+            usage = self._image_usage
+        else:
+            return
+        if parsed is None:
+            return
+        camera_name = parsed[-1]
+        with self._usage_lock:
+            usage[camera_name] = usage.get(camera_name, 0) + size
+
+    def add_timelapse(self, timelapse_file):
+        file = f"{self._timelapse_video_file_path}{timelapse_file}"
+        self._catalog.add_timelapses([(timelapse_file, os.path.getsize(file), utils.probe_duration(self._logger, file))])
+
+    def reconcile(self):
+        start = time.time()
+        changed = False
+        video_files, image_files = self._recordings_index.reconcile()
+        if video_files is not None:
+            known = self._catalog.get_video_filenames()
+            added = video_files - known
+            removed = known - video_files
+            self._catalog.add_videos([
+                (file, size, None) for file, size in self._get_sizes(self._video_storage.get_path, added)
+            ])
+            self._catalog.remove_videos(removed)
+            changed = changed or len(added) > 0 or len(removed) > 0
+        if image_files is not None:
+            known = self._catalog.get_image_filenames()
+            added = image_files - known
+            removed = known - image_files
+            self._catalog.add_images(list(self._get_sizes(self._image_storage.get_path, added)))
+            self._catalog.remove_images(removed)
+            changed = changed or len(added) > 0 or len(removed) > 0
+        if changed:
+            self._load_usage()
+            self._changed()
+
+        timelapse_files = set(filter(
+            lambda x: parse_timelapse_filename(x) is not None, os.listdir(self._timelapse_video_file_path)
+        ))
+        known = self._catalog.get_timelapse_filenames()
+        self._catalog.add_timelapses([
+            (file, size, None) for file, size in self._get_sizes(self._get_timelapse_video_path, timelapse_files - known)
+        ])
+        self._catalog.remove_timelapses(known - timelapse_files)
+        metrics.observe("nvr_file_scan_seconds", {"kind": "reconcile"}, time.time() - start)
+
+    def purge_async(self):
+        if self._purge_thread is not None and self._purge_thread.is_alive():
+            self._logger.info("Purge already running, skipping")
+            return
+        self._purge_thread = threading.Thread(target=self.purge)
+        self._purge_thread.start()
+
+    def purge(self):
+        start = time.time()
+        if self._retention_mode == "quota":
+            videos, images = self.remove_over_quota()
+        else:
+            videos = self.remove_old_videos()
+            images = self.remove_old_images()
+        timelapse_images = self.remove_old_timelapse_images()
+        timelapse_videos = self.remove_old_timelapse_videos()
+        elapsed = time.time() - start
+        metrics.observe("nvr_file_scan_seconds", {"kind": "purge"}, elapsed)
+        self._logger.info(
+            f"Purge done in {elapsed:.1f}s, removed {videos[0]} videos ({videos[1]} bytes), "
+            f"{images[0]} images ({images[1]} bytes), "
+            f"{timelapse_images[0]} timelapse images ({timelapse_images[1]} bytes) and "
+            f"{timelapse_videos[0]} timelapse videos ({timelapse_videos[1]} bytes)"
         )
-        for file in files:
-            time = datetime.strptime(file[0:15], "%Y%m%d_%H%M%S")
-            days = (datetime.now() - time).days
-            if days > self._purge_video_days:
-                self._logger.info(f"Removing file {file}")
-                os.remove(f"{self._video_file_path}/{file}")
+        return {
+            "videos": videos,
+            "images": images,
+            "timelapse_images": timelapse_images,
+            "timelapse_videos": timelapse_videos,
+        }
+
+    def remove_old_videos(self):
+        cutoff = (datetime.now() - timedelta(days=self._purge_video_days + 1)).strftime("%Y%m%d_%H%M%S")
+        removed = self._remove_shards("videos", cutoff[0:8])
+        return _add(removed, self._remove_files("videos", self._catalog.get_videos_before(cutoff)))
 
     def remove_old_images(self):
-        files = list(
-            filter(lambda x: x.endswith(".jpeg"), os.listdir(self._image_file_path))
-        )
-        for file in files:
-            time = datetime.strptime(file[0:15], "%Y%m%d_%H%M%S")
-            days = (datetime.now() - time).days
-            if days > self._purge_image_days:
+        cutoff = (datetime.now() - timedelta(days=self._purge_image_days + 1)).strftime("%Y%m%d_%H%M%S")
+        removed = self._remove_shards("images", cutoff[0:8])
+        return _add(removed, self._remove_files("images", self._catalog.get_images_before(cutoff)))
+
+    def remove_over_quota(self):
+        videos = (0, 0)
+        images = (0, 0)
+        for camera_name, quota_bytes in self._camera_video_quota_bytes.items():
+            usage = self.get_usage()["videos"].get(camera_name, 0)
+            if usage > quota_bytes:
+                videos = _add(videos, self._remove_oldest("videos", usage - quota_bytes, camera_name))
+        if self._video_quota_bytes:
+            usage = sum(self.get_usage()["videos"].values())
+            if usage > self._video_quota_bytes:
+                videos = _add(videos, self._remove_oldest("videos", usage - self._video_quota_bytes))
+        if self._image_quota_bytes:
+            usage = sum(self.get_usage()["images"].values())
+            if usage > self._image_quota_bytes:
+                images = _add(images, self._remove_oldest("images", usage - self._image_quota_bytes))
+        if self._min_free_bytes:
+            free_bytes = shutil.disk_usage(self._video_storage.get_root()).free
+            if free_bytes < self._min_free_bytes:
+                removed_videos, removed_images = self._remove_oldest_recordings(self._min_free_bytes - free_bytes)
+                videos = _add(videos, removed_videos)
+                images = _add(images, removed_images)
+        return videos, images
+
+    def _remove_oldest(self, kind, bytes_to_free, camera_name=None):
+        get_oldest = self._catalog.get_oldest_videos if kind == "videos" else self._catalog.get_oldest_images
+        removed = (0, 0)
+        while removed[1] < bytes_to_free:
+            files = []
+            needed = bytes_to_free - removed[1]
+            for file, size, timestamp in get_oldest(self._purge_batch_size, camera_name):
+                if needed <= 0:
+                    break
+                files.append((file, size))
+                needed = needed - size
+            if len(files) == 0:
+                break
+            if removed[0] > 0:
+                time.sleep(self._purge_batch_sleep)
+            removed = _add(removed, self._remove_files(kind, files))
+        return removed
+
+    def _remove_oldest_recordings(self, bytes_to_free):
+        videos = (0, 0)
+        images = (0, 0)
+        while videos[1] + images[1] < bytes_to_free:
+            candidates = [
+                (timestamp, "videos", file, size)
+                for file, size, timestamp in self._catalog.get_oldest_videos(self._purge_batch_size)
+            ] + [
+                (timestamp, "images", file, size)
+                for file, size, timestamp in self._catalog.get_oldest_images(self._purge_batch_size)
+            ]
+            candidates.sort()
+            batch = {"videos": [], "images": []}
+            needed = bytes_to_free - videos[1] - images[1]
+            for timestamp, kind, file, size in candidates[0:self._purge_batch_size]:
+                if needed <= 0:
+                    break
+                batch[kind].append((file, size))
+                needed = needed - size
+            if len(batch["videos"]) == 0 and len(batch["images"]) == 0:
+                break
+            if videos[0] + images[0] > 0:
+                time.sleep(self._purge_batch_sleep)
+            videos = _add(videos, self._remove_files("videos", batch["videos"]))
+            images = _add(images, self._remove_files("images", batch["images"]))
+        return videos, images
+
+    def remove_old_timelapse_images(self):
+        cutoff = (datetime.now() - timedelta(days=self._purge_timelapse_image_days + 1)).strftime("%Y%m%d_%H%M%S")
+        files = list(filter(
+            lambda x: x.endswith(".jpeg") and x[0:15] < cutoff, os.listdir(self._timelapse_image_file_path)
+        ))
+        files.sort()
+        return self._remove_files("timelapse_images", list(self._get_sizes(self._get_timelapse_image_path, files)))
+
+    def remove_old_timelapse_videos(self):
+        year = (datetime.now() - timedelta(days=self._purge_timelapse_video_days + 1)).year
+        return self._remove_files("timelapse_videos", self._catalog.get_timelapses_before(year))
+
+    def _get_removers(self, kind):
+        return {
+            "videos": (self._video_storage.remove, self._recordings_index.remove_video, self._catalog.remove_videos),
+            "images": (self._image_storage.remove, self._remove_image_from_index, self._catalog.remove_images),
+            "timelapse_images": (lambda file: self._remove_file(self._get_timelapse_image_path(file)), None, None),
+            "timelapse_videos": (
+                lambda file: self._remove_file(self._get_timelapse_video_path(file)), None, self._catalog.remove_timelapses
+            ),
+        }[kind]
+
+    def _remove_shards(self, kind, date):
+        storage = self._video_storage if kind == "videos" else self._image_storage
+        remove_file, remove_from_index, remove_from_catalog = self._get_removers(kind)
+        removed_files = 0
+        removed_bytes = 0
+        for i, directory in enumerate(storage.get_shards_before(date)):
+            if i > 0:
+                time.sleep(self._purge_batch_sleep)
+            self._logger.info(f"Removing directory {directory}")
+            files = storage.remove_shard(directory)
+            for file, size in files:
+                remove_from_index(file)
+                self._update_usage(kind, file, -size)
+            remove_from_catalog([file for file, size in files])
+            removed_files = removed_files + len(files)
+            removed_bytes = removed_bytes + sum([size for file, size in files])
+            self._changed()
+        return removed_files, removed_bytes
+
+    def _remove_files(self, kind, files):
+        remove_file, remove_from_index, remove_from_catalog = self._get_removers(kind)
+        removed_files = 0
+        removed_bytes = 0
+        for i in range(0, len(files), self._purge_batch_size):
+            if i > 0:
+                time.sleep(self._purge_batch_sleep)
+            batch = [(file, size) for file, size in files[i:i + self._purge_batch_size] if not file.endswith("_tmp.mp4")]
+            for file, size in batch:
                 self._logger.info(f"Removing file {file}")
-                os.remove(f"{self._image_file_path}/{file}")
+                if remove_file(file):
+                    removed_files = removed_files + 1
+                    removed_bytes = removed_bytes + size
+                if remove_from_index is not None:
+                    remove_from_index(file)
+                self._update_usage(kind, file, -size)
+            if remove_from_catalog is not None:
+                remove_from_catalog([file for file, size in batch])
+            if kind in ["videos", "images"] and len(batch) > 0:
+                self._changed()
+        return removed_files, removed_bytes
+
+    def _remove_image_from_index(self, image_file):
+        self._recordings_index.remove_image(image_file)
+        self._thumbnail_cache.remove(image_file)
+
+    def _get_timelapse_image_path(self, file):
+        return f"{self._timelapse_image_file_path}{file}"
+
+    def _get_timelapse_video_path(self, file):
+        return f"{self._timelapse_video_file_path}{file}"
+
+    def _get_sizes(self, get_path, files):
+        for file in files:
+            try:
+                yield file, os.path.getsize(get_path(file))
+            except FileNotFoundError:
+                pass
+
+    def _remove_file(self, file):
+        try:
+            os.remove(file)
+            return True
+        except FileNotFoundError:
+            self._logger.warning(f"File {file} already removed")
+            return False
 
     def get_latest_image(self, camera):
-        return self._get_latest_file(f"_{camera}.jpeg", self._image_file_path)
+        return self._image_storage.get_latest_file(f"_{camera}.jpeg", camera)
 
     def get_latest_video(self, camera):
-        return self._get_latest_file(f"_{camera}.mp4", self._video_file_path)
+        return self._video_storage.get_latest_file(f"_{camera}.mp4", camera)
 
     def get_latest_image(self):
-        return self._get_latest_file(".jpeg", self._image_file_path)
+        return self._image_storage.get_latest_file(".jpeg")
 
     def get_latest_video(self):
-        return self._get_latest_file(".mp4", self._video_file_path)
+        return self._video_storage.get_latest_file(".mp4")
 
-    def _get_latest_file(self, endswith, file_path):
-        files = list(filter(lambda x: x.endswith(endswith), os.listdir(file_path)))
-        files.sort(reverse=True)
-        if len(files) > 0:
-            return files[0]
-        else:
-            return None
+
+def _add(removed, more):
+    return removed[0] + more[0], removed[1] + more[1]
@@ -0,0 +1,117 @@
+from multiprocessing import shared_memory
+import cv2
+import numpy
+import time
+
+
+_LATEST_SEQUENCE = 0
+_LATEST_LIVE = 1
+_LATEST_PUBLISHED_MS = 2
+_FRAMES = 3
+_GRAB_FAILURES = 4
+_RESTARTS = 5
+_PROFILE_MS = 6
+_PROFILE_INTERVAL_US = 7
+_HEADER_WORDS = 8
+
+
+class SharedFrameBuffer(object):
+    def __init__(self, width, height, slots=3, shm=None):
+        self._width = width
+        self._height = height
+        self._slots = slots
+        self._owner = shm is None
+
+        header_size = (_HEADER_WORDS + slots) * 8
+        frame_size = width * height * 3
+        if shm is None:
+            shm = shared_memory.SharedMemory(create=True, size=header_size + slots * frame_size)
+            shm.buf[:header_size] = bytes(header_size)
+        self._shm = shm
+
+        self._header = numpy.ndarray((_HEADER_WORDS,), dtype=numpy.int64, buffer=shm.buf)
+        self._generations = numpy.ndarray(
+            (slots,), dtype=numpy.int64, buffer=shm.buf, offset=_HEADER_WORDS * 8
+        )
+        self._frames = numpy.ndarray(
+            (slots, height, width, 3), dtype=numpy.uint8, buffer=shm.buf, offset=header_size
+        )
+
+    def __getstate__(self):
+        return (self._width, self._height, self._slots, self._shm)
+
+    def __setstate__(self, state):
+        width, height, slots, shm = state
+        self.__init__(width, height, slots, shm)
+
+    def publish(self, frame, live=True):
+        if frame.shape != self._frames.shape[1:]:
+            frame = cv2.resize(frame, (self._width, self._height))
+        sequence = int(self._header[_LATEST_SEQUENCE]) + 1
+        slot = sequence % self._slots
+        self._generations[slot] = 2 * sequence - 1
+        self._frames[slot] = frame
+        self._generations[slot] = 2 * sequence
+        self._header[_LATEST_LIVE] = 1 if live else 0
+        self._header[_LATEST_PUBLISHED_MS] = int(time.time() * 1000)
+        self._header[_LATEST_SEQUENCE] = sequence
+        return sequence
+
+    def is_live(self):
+        return int(self._header[_LATEST_LIVE]) == 1
+
+    def get_age(self):
+        return time.time() - int(self._header[_LATEST_PUBLISHED_MS]) / 1000
+
+    def count_frame(self):
+        self._header[_FRAMES] += 1
+
+    def count_grab_failure(self):
+        self._header[_GRAB_FAILURES] += 1
+
+    def count_restart(self):
+        self._header[_RESTARTS] += 1
+
+    def get_counters(self):
+        return {
+            "frames": int(self._header[_FRAMES]),
+            "grab_failures": int(self._header[_GRAB_FAILURES]),
+            "restarts": int(self._header[_RESTARTS]),
+        }
+
+    def request_profile(self, seconds, interval):
+        self._header[_PROFILE_INTERVAL_US] = int(interval * 1000000)
+        self._header[_PROFILE_MS] = int(seconds * 1000)
+
+    def take_profile_request(self):
+        milliseconds = int(self._header[_PROFILE_MS])
+        if milliseconds == 0:
+            return None
+        self._header[_PROFILE_MS] = 0
+        return milliseconds / 1000, int(self._header[_PROFILE_INTERVAL_US]) / 1000000
+
+    def get_sequence(self):
+        return int(self._header[_LATEST_SEQUENCE])
+
+    def read(self):
+        while True:
+            sequence = int(self._header[_LATEST_SEQUENCE])
+            if sequence == 0:
+                return 0, None
+            slot = sequence % self._slots
+            generation = int(self._generations[slot])
+            if generation == 2 * sequence:
+                frame = self._frames[slot].copy()
+                if int(self._generations[slot]) == generation:
+                    return sequence, frame
+            # The writer is overwriting this slot; yield so it can finish instead
+            # of spinning, which would also block the hub in gevent mode.
+            time.sleep(0)
+
+    def close(self):
+        self._header = None
+        self._generations = None
+        self._frames = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
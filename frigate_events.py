@@ -0,0 +1,74 @@
+import threading
+import time
+
+
+class FrigateEvents(object):
+    def __init__(self, logger, frigate_proxy, poll_interval, refresh_seconds, max_age_days, limit):
+        self._logger = logger
+        self._frigate_proxy = frigate_proxy
+        self._poll_interval = poll_interval
+        self._refresh_seconds = refresh_seconds
+        self._max_age_seconds = max_age_days * 24 * 3600
+        self._limit = limit
+
+        self._lock = threading.Lock()
+        self._events = {}
+        self._sorted_events = []
+        self._last_success = None
+        self._poll_thread = None
+
+    def start(self):
+        self._poll_thread = threading.Thread(target=self._run, daemon=True)
+        self._poll_thread.start()
+
+    def _run(self):
+        while True:
+            self.poll()
+            time.sleep(self._poll_interval)
+
+    def poll(self):
+        now = time.time()
+        with self._lock:
+            if len(self._sorted_events) > 0:
+                after = self._sorted_events[0]["start_time"] - self._refresh_seconds
+            else:
+                after = now - self._max_age_seconds
+
+        start = time.time()
+        try:
+            events = self._frigate_proxy.get_json(
+                f"/api/events?include_thumbnails=0&after={after:.0f}&limit={self._limit}"
+            )
+        except Exception as err:
+            self._logger.warning(f"Failed to poll Frigate events: {err}")
+            return
+        elapsed = time.time() - start
+
+        with self._lock:
+            for event in events:
+                self._events[event["id"]] = event
+            cutoff = now - self._max_age_seconds
+            for event_id in [event_id for event_id, event in self._events.items() if event["start_time"] < cutoff]:
+                del self._events[event_id]
+            self._sorted_events = sorted(self._events.values(), key=lambda x: x["start_time"], reverse=True)
+            self._last_success = now
+        if len(events) > 0:
+            self._logger.info(f"Polled {len(events)} Frigate events in {elapsed:.2f}s")
+
+    def is_stale(self):
+        with self._lock:
+            return self._last_success is None or time.time() - self._last_success > 3 * self._poll_interval
+
+    def is_ended(self, event_id):
+        with self._lock:
+            event = self._events.get(event_id)
+        return event is not None and event.get("end_time") is not None
+
+    def get_events(self, camera_name=None, label=None, page=0, page_size=50):
+        with self._lock:
+            events = self._sorted_events
+        if camera_name is not None:
+            events = [event for event in events if event["camera"].removeprefix("camera_") == camera_name]
+        if label is not None:
+            events = [event for event in events if event["label"] == label]
+        return events[page * page_size:(page + 1) * page_size], len(events)
@@ -0,0 +1,195 @@
+from collections import OrderedDict
+from flask import Response, send_file
+import json
+import os
+import threading
+import time
+import urllib.parse
+from http_pool import HTTPConnectionPool
+from metrics import metrics
+
+
+_FORWARDED_REQUEST_HEADERS = ["Range", "If-Range", "If-None-Match", "If-Modified-Since"]
+_BODILESS_STATUSES = [204, 304]
+_FORWARDED_RESPONSE_HEADERS = [
+    "Content-Type",
+    "Content-Length",
+    "Content-Range",
+    "Accept-Ranges",
+    "ETag",
+    "Last-Modified",
+    "Cache-Control",
+]
+
+
+class FrigateProxy(object):
+    def __init__(
+        self,
+        logger,
+        frigate_base_url,
+        max_connections,
+        timeout,
+        chunk_size,
+        snapshot_cache_path,
+        snapshot_cache_bytes,
+    ):
+        self._logger = logger
+        self._chunk_size = chunk_size
+        self._snapshot_cache_path = snapshot_cache_path
+        self._snapshot_cache_bytes = snapshot_cache_bytes
+        self._pool = HTTPConnectionPool(frigate_base_url, max_connections, timeout)
+
+        self._snapshot_lock = threading.Lock()
+        self._snapshots = OrderedDict()
+        self._snapshot_total_bytes = 0
+        if self._snapshot_cache_path:
+            os.makedirs(self._snapshot_cache_path, exist_ok=True)
+            files = filter(lambda x: not x.startswith("."), os.listdir(self._snapshot_cache_path))
+            for file in sorted(files, key=lambda x: os.path.getmtime(f"{self._snapshot_cache_path}{x}")):
+                self._add_cached_snapshot(file, os.path.getsize(f"{self._snapshot_cache_path}{file}"))
+
+    def get_json(self, path):
+        start = time.time()
+        connection, response = self._pool.request("GET", path)
+        metrics.observe("nvr_frigate_request_seconds", {"kind": "json"}, time.time() - start)
+        try:
+            if response.status != 200:
+                raise Exception(f"Frigate responded {response.status} {response.reason} for {path}")
+            return json.loads(response.read())
+        finally:
+            self._pool.release(connection, response)
+
+    def get_clip(self, event_id, request_headers, method="GET"):
+        return self.proxy(f"/api/events/{urllib.parse.quote(event_id, safe='')}/clip.mp4", request_headers, method)
+
+    def get_snapshot(self, event_id, request_headers, method="GET", ended=False):
+        path = f"/api/events/{urllib.parse.quote(event_id, safe='')}/snapshot.jpg"
+        if not self._snapshot_cache_path or method != "GET":
+            return self.proxy(path, request_headers, method)
+
+        file = f"{urllib.parse.quote(event_id, safe='')}.jpg"
+        with self._snapshot_lock:
+            cached = file in self._snapshots
+            if cached:
+                self._snapshots.move_to_end(file)
+        if cached:
+            try:
+                return self._send_snapshot(file)
+            except FileNotFoundError:
+                pass
+
+        # Frigate keeps replacing the snapshot while an event is in progress,
+        # so only snapshots of ended events are cached.
+        if not ended:
+            return self.proxy(path, request_headers, method)
+
+        start = time.time()
+        try:
+            connection, response = self._pool.request("GET", path)
+        except Exception as err:
+            self._logger.error(f"Failed to fetch Frigate snapshot {event_id}: {err}")
+            return ("Bad Gateway", 502)
+        metrics.observe("nvr_frigate_request_seconds", {"kind": "snapshot"}, time.time() - start)
+        try:
+            contents = response.read()
+            status = response.status
+            headers = self._get_response_headers(response)
+        finally:
+            self._pool.release(connection, response)
+        elapsed = time.time() - start
+        self._logger.info(f"Fetched Frigate snapshot {event_id} in {elapsed:.2f}s")
+        if status == 200:
+            self._store_snapshot(file, contents)
+            return self._send_snapshot(file)
+        return Response(contents, status=status, headers=headers)
+
+    def _send_snapshot(self, file):
+        return send_file(os.path.abspath(f"{self._snapshot_cache_path}{file}"), mimetype="image/jpeg")
+
+    def proxy(self, path, request_headers, method="GET"):
+        headers = {}
+        for header in _FORWARDED_REQUEST_HEADERS:
+            if header in request_headers:
+                headers[header] = request_headers[header]
+
+        start = time.time()
+        try:
+            connection, response = self._pool.request(method, path, headers)
+        except Exception as err:
+            self._logger.error(f"Failed to proxy Frigate request {path}: {err}")
+            return ("Bad Gateway", 502)
+        elapsed = time.time() - start
+        metrics.observe("nvr_frigate_request_seconds", {"kind": "proxy"}, elapsed)
+        self._logger.info(f"Frigate responded {response.status} for {path} in {elapsed:.2f}s")
+
+        headers = self._get_response_headers(response)
+        if method == "HEAD" or response.status in _BODILESS_STATUSES:
+            try:
+                response.read()
+            finally:
+                self._pool.release(connection, response)
+            proxy_response = Response(status=response.status, headers=headers)
+            if "Content-Length" in headers:
+                proxy_response.headers["Content-Length"] = headers["Content-Length"]
+            return proxy_response
+
+        return Response(
+            _ProxyBody(self._pool, connection, response, self._chunk_size),
+            status=response.status,
+            headers=headers,
+            direct_passthrough=True,
+        )
+
+    def _get_response_headers(self, response):
+        headers = {}
+        for header in _FORWARDED_RESPONSE_HEADERS:
+            value = response.getheader(header)
+            if value is not None:
+                headers[header] = value
+        return headers
+
+    def _store_snapshot(self, file, contents):
+        temp_file = f"{self._snapshot_cache_path}.{file}.tmp"
+        with open(temp_file, "wb") as f:
+            f.write(contents)
+        os.replace(temp_file, f"{self._snapshot_cache_path}{file}")
+        self._add_cached_snapshot(file, len(contents))
+
+    def _add_cached_snapshot(self, file, size):
+        evicted = []
+        with self._snapshot_lock:
+            self._snapshot_total_bytes = self._snapshot_total_bytes - self._snapshots.pop(file, 0) + size
+            self._snapshots[file] = size
+            while self._snapshot_total_bytes > self._snapshot_cache_bytes and len(self._snapshots) > 0:
+                evicted_file, evicted_size = self._snapshots.popitem(last=False)
+                self._snapshot_total_bytes = self._snapshot_total_bytes - evicted_size
+                evicted.append(evicted_file)
+        for evicted_file in evicted:
+            try:
+                os.remove(f"{self._snapshot_cache_path}{evicted_file}")
+            except FileNotFoundError:
+                pass
+
+
+class _ProxyBody(object):
+    def __init__(self, pool, connection, response, chunk_size):
+        self._pool = pool
+        self._connection = connection
+        self._response = response
+        self._chunk_size = chunk_size
+        self._lock = threading.Lock()
+        self._released = False
+
+    def __iter__(self):
+        while True:
+            chunk = self._response.read(self._chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def close(self):
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        self._pool.release(self._connection, self._response)
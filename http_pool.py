@@ -0,0 +1,64 @@
+import http.client
+import threading
+import urllib.parse
+
+
+class HTTPConnectionPool(object):
+    def __init__(self, base_url, max_connections, timeout, ssl_context=None):
+        url = urllib.parse.urlsplit(base_url)
+        self._scheme = url.scheme
+        self._host = url.hostname
+        self._port = url.port
+        self._base_path = url.path.rstrip("/")
+        self._timeout = timeout
+        self._ssl_context = ssl_context
+
+        self._lock = threading.Lock()
+        self._idle = []
+        self._semaphore = threading.BoundedSemaphore(max_connections)
+
+    def request(self, method, path, headers={}):
+        if not self._semaphore.acquire(timeout=self._timeout):
+            raise Exception(f"Timed out after {self._timeout}s waiting for a connection to {self._host}")
+        try:
+            return self._request(method, path, headers)
+        except Exception:
+            self._semaphore.release()
+            raise
+
+    def _request(self, method, path, headers):
+        for attempt in range(2):
+            connection, reused = self._get_connection(attempt == 0)
+            try:
+                connection.request(method, f"{self._base_path}{path}", headers=headers)
+                return connection, connection.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                connection.close()
+                if not reused:
+                    raise
+            except Exception:
+                connection.close()
+                raise
+
+    def release(self, connection, response):
+        try:
+            if response.isclosed() and not response.will_close:
+                with self._lock:
+                    self._idle.append(connection)
+            else:
+                response.close()
+                connection.close()
+        finally:
+            self._semaphore.release()
+
+    def _get_connection(self, reuse):
+        with self._lock:
+            if reuse and len(self._idle) > 0:
+                return self._idle.pop(), True
+        if self._scheme == "https":
+            connection = http.client.HTTPSConnection(
+                self._host, self._port, timeout=self._timeout, context=self._ssl_context
+            )
+        else:
+            connection = http.client.HTTPConnection(self._host, self._port, timeout=self._timeout)
+        return connection, False
@@ -0,0 +1,103 @@
+import bisect
+
+
+_LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+_DURATION_BUCKETS = [0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600]
+
+
+class Metrics(object):
+    def __init__(self):
+        self._metrics = {}
+        self._series = {}
+        self._collectors = []
+
+    def counter(self, name, help):
+        self._metrics[name] = ("counter", help, None, 1)
+        self._series[name] = {}
+
+    def gauge(self, name, help):
+        self._metrics[name] = ("gauge", help, None, 1)
+        self._series[name] = {}
+
+    def histogram(self, name, help, buckets, sample_every=1):
+        self._metrics[name] = ("histogram", help, buckets, sample_every)
+        self._series[name] = {}
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def inc(self, name, labels={}, value=1):
+        series = self._series[name]
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + value
+
+    def set(self, name, labels, value):
+        self._series[name][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name, labels, value):
+        series = self._series[name]
+        key = tuple(sorted(labels.items()))
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = [0, [0] * (len(self._metrics[name][2]) + 1), 0, 0.0]
+            series[key] = histogram
+        histogram[0] = histogram[0] + 1
+        if histogram[0] % self._metrics[name][3] != 0:
+            return
+        histogram[1][bisect.bisect_left(self._metrics[name][2], value)] += 1
+        histogram[2] = histogram[2] + 1
+        histogram[3] = histogram[3] + value
+
+    def render(self):
+        for collector in self._collectors:
+            collector()
+
+        lines = []
+        for name, (kind, help, buckets, sample_every) in self._metrics.items():
+            series = self._series[name]
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key, value in list(series.items()):
+                if kind != "histogram":
+                    lines.append(f"{name}{_format_labels(key)} {value}")
+                    continue
+                calls, counts, count, total = value
+                cumulative = 0
+                for le, bucket_count in zip(buckets + ["+Inf"], counts):
+                    cumulative = cumulative + bucket_count
+                    lines.append(f"{name}_bucket{_format_labels(key + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(key)} {total}")
+                lines.append(f"{name}_count{_format_labels(key)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(key):
+    if len(key) == 0:
+        return ""
+    labels = ",".join([f'{label}="{value}"' for label, value in key])
+    return f"{{{labels}}}"
+
+
+metrics = Metrics()
+
+metrics.gauge("nvr_stream_clients", "Active MJPEG clients")
+metrics.gauge("nvr_stream_decoding", "Whether the stream decode process is running")
+metrics.gauge("nvr_stream_decode_fps", "Frames grabbed per second since the previous scrape")
+metrics.counter("nvr_stream_frames_total", "Frames grabbed by the stream decode process")
+metrics.counter("nvr_stream_grab_failures_total", "Failed frame grabs in the stream decode process")
+metrics.counter("nvr_stream_restarts_total", "Stream (re)initialisations in the stream decode process")
+metrics.histogram(
+    "nvr_stream_frame_wait_seconds", "Time from frame publish to encode start, sampled", _LATENCY_BUCKETS, 10
+)
+metrics.histogram("nvr_stream_encode_seconds", "JPEG encode latency, sampled", _LATENCY_BUCKETS, 10)
+
+metrics.histogram("nvr_snapshot_seconds", "Snapshot latency by source", _LATENCY_BUCKETS)
+metrics.counter("nvr_snapshot_retries_total", "Snapshot HTTP retries")
+metrics.counter("nvr_snapshot_failures_total", "Snapshots that failed after all retries")
+metrics.counter("nvr_snapshot_coalesced_total", "Snapshot requests coalesced or skipped")
+
+metrics.histogram("nvr_ffmpeg_seconds", "ffmpeg process duration by job", _DURATION_BUCKETS)
+metrics.counter("nvr_ffmpeg_exits_total", "ffmpeg process exits by job and exit code")
+
+metrics.histogram("nvr_file_scan_seconds", "Directory scan and reconcile duration", _DURATION_BUCKETS)
+metrics.histogram("nvr_frigate_request_seconds", "Frigate time to response headers", _LATENCY_BUCKETS)
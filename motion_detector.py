@@ -0,0 +1,231 @@
+from datetime import datetime
+from datetime import timezone
+import cv2
+import json
+import logging
+import numpy
+import sys
+import threading
+import time
+import wsgi_server
+
+
+class MotionDetector(object):
+    def __init__(
+        self,
+        logger,
+        camera_name,
+        width,
+        threshold,
+        start_area,
+        end_area,
+        background_alpha,
+        min_duration,
+        end_seconds,
+        keep_interval,
+        mask,
+        zones,
+    ):
+        self._logger = logger
+        self._camera_name = camera_name
+        self._width = width
+        self._threshold = threshold
+        self._start_area = start_area
+        self._end_area = end_area
+        self._background_alpha = background_alpha
+        self._min_duration = min_duration
+        self._end_seconds = end_seconds
+        self._keep_interval = keep_interval
+        self._mask = mask
+        self._zones = zones
+
+        self._background = None
+        self._valid = None
+        self._zone_masks = None
+        self._active = False
+        self._motion_since = None
+        self._last_motion = None
+        self._last_keep = None
+        self._area = 0.0
+        self._frames = 0
+        self._process_seconds = 0.0
+
+        self._running = False
+        self._thread = None
+
+    def start(self, stream_camera, capture_camera):
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._run, args=(stream_camera, capture_camera), daemon=True
+        )
+        self._thread.start()
+
+    def close(self):
+        self._running = False
+
+    def get_stats(self):
+        return {
+            "active": self._active,
+            "area": round(self._area, 4),
+            "frames": self._frames,
+            "process_ms": round(1000 * self._process_seconds / max(self._frames, 1), 2),
+        }
+
+    def process(self, frame, now):
+        start = time.perf_counter()
+        motion = False
+        if frame is None:
+            self._background = None
+        else:
+            motion = wsgi_server.offload(self._detect, frame)
+        event = self._update(motion, now)
+        self._process_seconds = self._process_seconds + time.perf_counter() - start
+        self._frames = self._frames + 1
+        return event
+
+    def _detect(self, frame):
+        height = int(frame.shape[0] * self._width / frame.shape[1])
+        small = cv2.resize(frame, (self._width, height), interpolation=cv2.INTER_AREA)
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY).astype(numpy.float32)
+
+        if self._background is None or self._background.shape != gray.shape:
+            self._background = gray
+            self._area = 0.0
+            self._create_masks(gray.shape)
+            return False
+
+        changed = numpy.abs(gray - self._background) > self._threshold
+        self._background += self._background_alpha * (gray - self._background)
+        changed &= self._valid
+
+        self._area = 0.0
+        for zone_mask, zone_pixels in self._zone_masks:
+            self._area = max(self._area, numpy.count_nonzero(changed & zone_mask) / zone_pixels)
+        return self._area >= (self._end_area if self._active else self._start_area)
+
+    def _create_masks(self, shape):
+        height, width = shape
+        self._valid = numpy.ones(shape, dtype=bool)
+        for polygon in self._mask:
+            self._valid &= self._rasterize(polygon, width, height) == 0
+
+        zones = self._zones.values() if len(self._zones) > 0 else [[[0, 0], [1, 0], [1, 1], [0, 1]]]
+        self._zone_masks = []
+        for polygon in zones:
+            zone_mask = (self._rasterize(polygon, width, height) > 0) & self._valid
+            zone_pixels = numpy.count_nonzero(zone_mask)
+            if zone_pixels > 0:
+                self._zone_masks.append((zone_mask, zone_pixels))
+
+    def _rasterize(self, polygon, width, height):
+        image = numpy.zeros((height, width), dtype=numpy.uint8)
+        points = numpy.array([[x * (width - 1), y * (height - 1)] for x, y in polygon], dtype=numpy.int32)
+        cv2.fillPoly(image, [points], 1)
+        return image
+
+    def _update(self, motion, now):
+        if not self._active:
+            if not motion:
+                self._motion_since = None
+                return None
+            if self._motion_since is None:
+                self._motion_since = now
+            if now - self._motion_since < self._min_duration:
+                return None
+            self._active = True
+            self._last_motion = now
+            self._last_keep = now
+            return "start"
+
+        if motion:
+            self._last_motion = now
+            if now - self._last_keep >= self._keep_interval:
+                self._last_keep = now
+                return "keep"
+            return None
+        if now - self._last_motion >= self._end_seconds:
+            self._active = False
+            self._motion_since = None
+            return "end"
+        return None
+
+    def _run(self, stream_camera, capture_camera):
+        self._logger.info(f"Starting motion detection for {self._camera_name}")
+        frame_sequence = 0
+        while self._running:
+            stream_camera.touch()
+            sequence, frame = stream_camera.wait_frame(frame_sequence, 1)
+            if frame is None:
+                continue
+            frame_sequence = sequence
+            if not stream_camera.is_live():
+                frame = None
+
+            event = self.process(frame, time.time())
+            if event is None:
+                continue
+            timestamp = datetime.now(tz=timezone.utc).strftime("%Y%m%d_%H%M%S")
+            self._logger.info(f"Motion {event} for {self._camera_name} (area {self._area:.3f})")
+            if event == "start":
+                capture_camera.capture_start()
+                capture_camera.capture_keep(timestamp)
+            elif event == "keep":
+                capture_camera.capture_keep(timestamp)
+            else:
+                capture_camera.capture_end()
+        self._logger.info(f"Stopped motion detection for {self._camera_name}")
+
+
+def create_motion_detector(logger, camera_name, motion_config):
+    return MotionDetector(
+        logger,
+        camera_name,
+        motion_config["width"],
+        motion_config["threshold"],
+        motion_config["start_area"],
+        motion_config["end_area"],
+        motion_config["background_alpha"],
+        motion_config["min_duration"],
+        motion_config["end_seconds"],
+        motion_config["keep_interval"],
+        motion_config["mask"],
+        motion_config["zones"],
+    )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s in %(module)s: %(message)s")
+    logger = logging.getLogger(__name__)
+
+    if len(sys.argv) < 4 or sys.argv[1] != "replay":
+        print(f"Usage: {sys.argv[0]} replay <camera_name> <video_file>")
+        sys.exit(1)
+
+    with open("config.json", "r") as f:
+        config = json.load(f)
+    camera_config = next(camera for camera in config["cameras"] if camera["name"] == sys.argv[2])
+
+    motion_detector = create_motion_detector(logger, camera_config["name"], camera_config["motion"])
+    video_capture = cv2.VideoCapture(sys.argv[3])
+    fps = video_capture.get(cv2.CAP_PROP_FPS) or 1 / camera_config["stream"]["frame_sleep"]
+    frame_interval = max(1, round(fps * camera_config["stream"]["frame_sleep"]))
+
+    index = 0
+    while True:
+        success, frame = video_capture.read()
+        if not success:
+            break
+        index = index + 1
+        if index % frame_interval != 0:
+            continue
+        event = motion_detector.process(frame, index / fps)
+        if event is not None:
+            print(f"{index / fps:9.2f}s {event:<5} area={motion_detector.get_stats()['area']:.4f}")
+    video_capture.release()
+
+    stats = motion_detector.get_stats()
+    core_percent = 100 * stats["process_ms"] / 1000 / camera_config["stream"]["frame_sleep"]
+    print(
+        f"Processed {stats['frames']} frames in {stats['process_ms']:.2f}ms per frame, "
+        f"{core_percent:.1f}% of a core at {1 / camera_config['stream']['frame_sleep']:.0f} fps"
+    )
@@ -1,3 +1,8 @@
+if __name__ == "__main__":
+    import wsgi_server
+
+    wsgi_server.prepare()
+
 from flask import Flask
 from flask import request, send_from_directory, abort
 from flask import Response
@@ -5,26 +10,35 @@ import logging
 from datetime import datetime
 import pytz
 import json
-from os import listdir, path
 import ipaddress
 from stream_camera import StreamCamera
 from capture_camera import CaptureCamera
+from segment_buffer import SegmentBuffer
 from file_manager import FileManager
+from catalog import Catalog, parse_image_filename, parse_video_filename
+from thumbnail_cache import ThumbnailCache
+from frigate_proxy import FrigateProxy
+from frigate_events import FrigateEvents
 from timelapse_camera import TimelapseCamera
+from timelapse_builder import TimelapseBuilder
+from motion_detector import create_motion_detector
+from metrics import metrics
+from profiler import RouteTimer, SamplingProfiler
+from snapshot_fetcher import SnapshotFetcher
+from storage import Storage
 import schedule
 import threading
 import time
 from datetime import timezone
-import urllib.request, json 
+import urllib.parse, json
 
 app = Flask(__name__)
 
 
 def require_internal(func):
     def wrapper_require_internal(*args, **kwargs):
-        if ipaddress.ip_address(request.remote_addr) in ipaddress.ip_network(
-            "172.0.0.0/8"
-        ) or ipaddress.ip_address("127.0.0.1"):
+        ip = ipaddress.ip_address(request.remote_addr)
+        if any(ip in network for network in internal_networks):
             return func(*args, **kwargs)
         return ("Unauthorized", 401)
 
@@ -32,15 +46,23 @@ def require_internal(func):
     return wrapper_require_internal
 
 
-def _get_lastchanged():
-    files = list(filter(lambda x: x.endswith(".jpeg"), listdir(image_file_path)))
-    files.extend(list(filter(lambda x: x.endswith(".mp4"), listdir(video_file_path))))
-    files.sort(reverse=True)
-    return files[0]
-
 @app.route("/recordings/lastchanged")
 def get_recordings_lastchanged():
-    return _get_lastchanged()
+    change_token = str(file_manager.get_change_token())
+    since = request.args.get("since")
+    if since is None and request.if_none_match:
+        since = next(iter(request.if_none_match), None)
+    wait = request.args.get("wait", 0, type=float)
+    if wait > 0 and since == change_token:
+        change_token = str(file_manager.wait_for_change(int(since), min(wait, 60)))
+
+    if request.if_none_match.contains(change_token):
+        response = Response(status=304)
+    else:
+        response = Response(change_token, mimetype="text/plain")
+    response.set_etag(change_token)
+    response.cache_control.no_cache = True
+    return response
 
 @app.route("/recordings")
 def get_recordings():
@@ -79,7 +101,7 @@ def get_recordings():
                     xhr.open ( "GET", "/recordings/lastchanged");
                     xhr.onreadystatechange = function () {{
                         if ( xhr.readyState === XMLHttpRequest.DONE && xhr.status === 200) {{
-                            if (xhr.response != "{_get_lastchanged()}") {{
+                            if (xhr.response != "{file_manager.get_change_token()}") {{
                                 location.reload();
                             }}
                         }}
@@ -93,18 +115,21 @@ def get_recordings():
         <ul>
 """
 
-    file_manager.remove_old_videos()
-    file_manager.remove_old_images()
-
     tz = pytz.timezone(config["timezone"])
+    image_route = "images" if request.args.get("full") else "thumbnails"
 
-    recordings, orphan_images = file_manager.get_mapped_recordings()
+    camera_name = request.args.get("camera")
+    if camera_name is not None and camera_name not in camera_display_names:
+        abort(404)
+    recordings, orphan_images = file_manager.get_mapped_recordings(
+        camera_name, _parse_local_time(request.args.get("since"), tz), _parse_local_time(request.args.get("until"), tz)
+    )
 
     for orphan_image in orphan_images:
         local_timestamp = orphan_image["timestamp"].replace(tzinfo=pytz.utc).astimezone(tz).strftime("%Y-%m-%d %H:%M:%S")
         camera_display_name = camera_display_names[orphan_image["camera_name"]]
         html += f"<li>{local_timestamp}<br/>"
-        html += f'<img style="width:90%; border: 2px solid red;" src="./images/{orphan_image["image_filename"]}" alt="{camera_display_name} - {local_timestamp}" />'
+        html += f'<a target="_blank" href="./images/{orphan_image["image_filename"]}"><img style="width:90%; border: 2px solid red;" src="./{image_route}/{orphan_image["image_filename"]}" alt="{camera_display_name} - {local_timestamp}" /></a>'
         html += "</li>"
 
     for recording in recordings:
@@ -112,10 +137,10 @@ def get_recordings():
         camera_display_name = camera_display_names[recording["camera_name"]]
 
         html += f"<li>{local_timestamp}<br/>"
-        html += f'<a target="_blank" href="./videos/{recording["video_filename"]}"><img style="width:90%;" src="./images/{recording["image_filename"]}" alt="{camera_display_name} - {local_timestamp}" /></a>'
+        html += f'<a target="_blank" href="./videos/{recording["video_filename"]}"><img style="width:90%;" src="./{image_route}/{recording["image_filename"]}" alt="{camera_display_name} - {local_timestamp}" /></a>'
         for extra_images in recording["extra_images"]:
             image_local_time = extra_images["timestamp"].replace(tzinfo=pytz.utc).astimezone(tz).strftime("%Y-%m-%d %H:%M:%S")
-            html += f'<img style="width:45%;" src="./images/{extra_images["filename"]}" alt="{camera_display_name} - {image_local_time}" />'
+            html += f'<a target="_blank" href="./images/{extra_images["filename"]}"><img style="width:45%;" src="./{image_route}/{extra_images["filename"]}" alt="{camera_display_name} - {image_local_time}" /></a>'
         html += "</li>"
     html += """
         </ul>
@@ -125,6 +150,18 @@ def get_recordings():
     return html
 
 
+def _parse_local_time(value, tz):
+    if value is None:
+        return None
+    try:
+        local_time = datetime.fromisoformat(value)
+    except ValueError:
+        abort(400)
+    if local_time.tzinfo is None:
+        local_time = tz.localize(local_time)
+    return local_time.astimezone(pytz.utc).strftime("%Y%m%d_%H%M%S")
+
+
 @app.route("/events")
 def get_events():
     html = f"""
@@ -158,24 +195,35 @@ def get_events():
         <ul>
 """
 
-    with urllib.request.urlopen(f"{frigate_base_url}/api/events?include_thumbnails=0") as url:
-        events = json.load(url)
-        tz = pytz.timezone(config["timezone"])
-        for event in events:
-            if event["label"] == "person":
-                local_timestamp = datetime.fromtimestamp(event["start_time"]).replace(tzinfo=pytz.utc).astimezone(tz).strftime("%Y-%m-%d %H:%M:%S")
-                camera_display_name = camera_display_names[event["camera"].removeprefix("camera_")]
-
-                html += f"<li>{local_timestamp}<br/>"
-                if event["has_clip"] and event["has_snapshot"]:
-                    html += f'<a target="_blank" href="./clips/{event["id"]}"><img style="width:90%;" src="./snapshots/{event["id"]}" alt="{camera_display_name} - {local_timestamp}" /></a>'
-                elif event["has_snapshot"]:
-                    html += f'<img style="width:90%; border: 2px solid red;" src="./snapshots/{event["id"]}" alt="{camera_display_name} - {local_timestamp}" />'
-                else:
-                    html += f'{camera_display_name} - {local_timestamp}'
-                html += "</li>"
+    camera_name = request.args.get("camera")
+    label = request.args.get("label", "person")
+    page = request.args.get("page", 0, type=int)
+    events, total = frigate_events.get_events(camera_name, label or None, page, events_page_size)
+    if frigate_events.is_stale():
+        html += "<li>Händelser kan vara inaktuella, Frigate svarar inte</li>"
+
+    tz = pytz.timezone(config["timezone"])
+    for event in events:
+        local_timestamp = datetime.fromtimestamp(event["start_time"]).replace(tzinfo=pytz.utc).astimezone(tz).strftime("%Y-%m-%d %H:%M:%S")
+        camera_display_name = camera_display_names[event["camera"].removeprefix("camera_")]
+
+        html += f"<li>{local_timestamp}<br/>"
+        if event["has_clip"] and event["has_snapshot"]:
+            html += f'<a target="_blank" href="./clips/{event["id"]}"><img style="width:90%;" src="./snapshots/{event["id"]}" alt="{camera_display_name} - {local_timestamp}" /></a>'
+        elif event["has_snapshot"]:
+            html += f'<img style="width:90%; border: 2px solid red;" src="./snapshots/{event["id"]}" alt="{camera_display_name} - {local_timestamp}" />'
+        else:
+            html += f'{camera_display_name} - {local_timestamp}'
+        html += "</li>"
     html += """
         </ul>
+"""
+    query = urllib.parse.urlencode({key: value for key, value in [("camera", camera_name), ("label", label)] if value is not None})
+    if page > 0:
+        html += f'<a href="./events?{query}&page={page - 1}">Nyare</a> '
+    if (page + 1) * events_page_size < total:
+        html += f'<a href="./events?{query}&page={page + 1}">Äldre</a>'
+    html += """
     </body>
 </html>
 """
@@ -214,18 +262,8 @@ def get_timelapses():
     <body>
         <ul>
 """
-    timelapse_files = list(filter(lambda x: x.endswith(".mp4"), listdir(timelapse_video_file_path)))
-    timelapse_files.sort(reverse=True)
-
-
-
-    for timelapse_file in timelapse_files:
-        timelapse_file_no_ext = path.splitext(timelapse_file)[0]
-        year = timelapse_file_no_ext[0:4]
-        hour = timelapse_file_no_ext[5:7]
-        camera_name = timelapse_file_no_ext[8:]
-
-        html += f'<li><a target="_blank" href="./timelapses/{timelapse_file}">{year}: {camera_display_names[camera_name]} {hour} UTC</a></li>'
+    for timelapse in file_manager.get_timelapses():
+        html += f'<li><a target="_blank" href="./timelapses/{timelapse["filename"]}">{timelapse["year"]}: {camera_display_names[timelapse["camera_name"]]} {timelapse["hour"]:02} UTC</a></li>'
 
     html += """
         </ul>
@@ -237,35 +275,52 @@ def get_timelapses():
 
 @app.route("/clips/<path:event_id>")
 def get_clips(event_id):
-    with urllib.request.urlopen(f"{frigate_base_url}/api/events/{event_id}/clip.mp4") as response:
-        contents = response.read()
-        info = response.info()
-        return Response(contents, mimetype=info.get_content_type())
+    return frigate_proxy.get_clip(event_id, request.headers, request.method)
 
 
 @app.route("/snapshots/<path:event_id>")
 def get_snapshots(event_id):
-    with urllib.request.urlopen(f"{frigate_base_url}/api/events/{event_id}/snapshot.jpg") as response:
-        contents = response.read()
-        info = response.info()
-        return Response(contents, mimetype=info.get_content_type())
+    return frigate_proxy.get_snapshot(
+        event_id, request.headers, request.method, frigate_events.is_ended(event_id)
+    )
 
 
 @app.route("/videos/<path:file>")
 def get_videos_file(file):
-    return send_from_directory(video_file_path, file, max_age=604800)
+    directory = video_storage.get_directory(file)
+    if directory is None:
+        abort(404)
+    return send_from_directory(directory, file, max_age=604800)
 
 
 @app.route("/images/<path:file>")
 def get_images_file(file):
-    return send_from_directory(image_file_path, file, max_age=604800)
+    directory = image_storage.get_directory(file)
+    if directory is None:
+        abort(404)
+    return send_from_directory(directory, file, max_age=604800)
+
+
+@app.route("/thumbnails/<path:file>")
+def get_thumbnails_file(file):
+    etag = thumbnail_cache.get_etag(file)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    thumbnail = thumbnail_cache.get(file)
+    if thumbnail is None:
+        abort(404)
+    return send_from_directory(
+        thumbnail_file_path, thumbnail, mimetype=thumbnail_cache.get_mimetype(), max_age=604800, etag=etag
+    )
 
 
 @app.route("/images/latest")
 def get_cameras_images_latest():
     file = file_manager.get_latest_image()
     if file:
-        return send_from_directory(image_file_path, file, max_age=0)
+        return send_from_directory(image_storage.get_directory(file), file, max_age=0)
     else:
         return "Not found", 404
 
@@ -273,10 +328,23 @@ def get_cameras_images_latest():
 def get_timelapses_file(file):
     return send_from_directory(timelapse_video_file_path, file, max_age=604800)
 
-def http_stream(stream_camera):
-    while True:
-        frame = stream_camera.get_jpeg()
-        yield (b"--frame\r\nContent-Type: image/jpeg\r\n\r\n" + frame + b"\r\n")
+def http_stream(stream_camera, profile, fps):
+    interval = 1 / fps
+    stream_camera.open_viewer(profile)
+    try:
+        sequence = 0
+        next_frame = time.monotonic()
+        while True:
+            delay = next_frame - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            sequence, frame = stream_camera.wait_jpeg(profile, sequence)
+            if frame is None:
+                return
+            next_frame = max(next_frame + interval, time.monotonic())
+            yield (b"--frame\r\nContent-Type: image/jpeg\r\n\r\n" + frame + b"\r\n")
+    finally:
+        stream_camera.close_viewer(profile)
 
 
 @app.route("/cameras/<path:camera_name>/stream/mjpeg")
@@ -284,12 +352,105 @@ def http_stream(stream_camera):
 def get_cameras_camera_stream_mjpeg(camera_name):
     if camera_name not in stream_cameras:
         abort(404)
+    if sum(stream_camera.get_viewers() for stream_camera in stream_cameras.values()) >= max_stream_clients:
+        return ("Too many stream clients", 503)
+    stream_camera = stream_cameras[camera_name]
+    profile = stream_camera.get_profile(
+        request.args.get("width", type=int), request.args.get("quality", type=int)
+    )
+    fps = request.args.get("fps", stream_camera.get_max_fps(), type=float)
+    fps = max(0.1, min(stream_camera.get_max_fps(), fps))
     return Response(
-        http_stream(stream_cameras[camera_name]),
+        http_stream(stream_camera, profile, fps),
         mimetype="multipart/x-mixed-replace; boundary=frame",
     )
 
 
+@app.route("/cameras/<path:camera_name>/snapshot.jpg")
+@require_internal
+def get_cameras_camera_snapshot(camera_name):
+    if camera_name not in stream_cameras:
+        abort(404)
+    stream_camera = stream_cameras[camera_name]
+    profile = stream_camera.get_profile(
+        request.args.get("width", type=int), request.args.get("quality", type=int)
+    )
+    sequence, jpeg = stream_camera.get_latest_jpeg(profile)
+    if jpeg is None:
+        return ("No frame available", 503)
+    etag = f"{started}-{sequence}-{profile[0]}-{profile[1]}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(jpeg, mimetype="image/jpeg")
+    response.set_etag(etag)
+    response.cache_control.max_age = snapshot_max_age
+    return response
+
+
+@app.route("/metrics")
+@require_internal
+def get_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/admin/profile/routes")
+@require_internal
+def get_admin_profile_routes():
+    return route_timer.get_stats()
+
+
+@app.route("/admin/profile/routes/start")
+@require_internal
+def get_admin_profile_routes_start():
+    route_timer.enable()
+    return "OK"
+
+
+@app.route("/admin/profile/routes/stop")
+@require_internal
+def get_admin_profile_routes_stop():
+    route_timer.disable()
+    return "OK"
+
+
+@app.route("/admin/profile/routes/reset")
+@require_internal
+def get_admin_profile_routes_reset():
+    route_timer.reset()
+    return "OK"
+
+
+@app.route("/admin/profile/sample")
+@require_internal
+def get_admin_profile_sample():
+    seconds, interval = _get_profile_args()
+    collapsed = sampling_profiler.sample(seconds, interval)
+    if collapsed is None:
+        return ("Profiler already running", 409)
+    return Response(collapsed, mimetype="text/plain")
+
+
+@app.route("/admin/profile/cameras/<path:camera_name>/sample")
+@require_internal
+def get_admin_profile_cameras_camera_sample(camera_name):
+    if camera_name not in stream_cameras:
+        abort(404)
+    seconds, interval = _get_profile_args()
+    collapsed = stream_cameras[camera_name].profile(seconds, interval)
+    if collapsed is None:
+        return ("No profile returned from stream process", 504)
+    return Response(collapsed, mimetype="text/plain")
+
+
+@app.route("/cameras/<path:camera_name>/stream/stats")
+@require_internal
+def get_cameras_camera_stream_stats(camera_name):
+    if camera_name not in stream_cameras:
+        abort(404)
+    return stream_cameras[camera_name].get_stats()
+
+
 @app.route("/cameras/<path:camera_name>/event/start")
 @require_internal
 def get_cameras_camera_event_start(camera_name):
@@ -342,9 +503,34 @@ def _replace_secrets(secrets, value):
         value = value.replace(f"{{{secret_key}}}", secret_value)
     return value
 
-def _schedule(timelapse_camera, i):
+def _get_image_stream_camera(camera_name, image_config):
+    if image_config["image_source"] == "stream":
+        return stream_cameras[camera_name]
+    return None
+
+def _schedule(timelapse_camera):
     schedule.every().hour.at(":00").do(timelapse_camera.capture_image_async)
-    schedule.every().day.at(f"{i:02}:01:00").do(timelapse_camera.build_videos)
+
+def _schedule_stream(stream_camera):
+    schedule.every(10).seconds.do(stream_camera.stop_if_idle)
+
+def _get_profile_args():
+    seconds = request.args.get("seconds", 10, type=float)
+    interval = request.args.get("interval", profile_sample_interval, type=float)
+    return max(1, min(profile_max_seconds, seconds)), max(0.001, interval)
+
+def _collect_metrics():
+    for stream_camera in stream_cameras.values():
+        stream_camera.collect_metrics()
+
+def _shutdown():
+    for stream_camera in stream_cameras.values():
+        stream_camera.close()
+    for segment_buffer in segment_buffers:
+        segment_buffer.close()
+    for motion_detector in motion_detectors:
+        motion_detector.close()
+    snapshot_fetcher.close()
 
 def _run_schedule():
     while True:
@@ -363,17 +549,84 @@ if __name__ == "__main__":
     with open("secrets.json", "r") as f:
         secrets = json.load(f)
 
-    video_file_path = config["video_file_path"]
+    video_storage = Storage(app.logger, config["video_file_path"], config["storage_layout"], parse_video_filename)
+    image_storage = Storage(app.logger, config["image_file_path"], config["storage_layout"], parse_image_filename)
     timelapse_video_file_path = config["timelapse_video_file_path"]
-    image_file_path = config["image_file_path"]
     frigate_base_url = config["frigate_base_url"]
 
+    frigate_proxy = FrigateProxy(
+        app.logger,
+        frigate_base_url,
+        config["frigate_max_connections"],
+        config["frigate_timeout"],
+        config["frigate_chunk_size"],
+        config["frigate_snapshot_cache_path"],
+        config["frigate_snapshot_cache_bytes"],
+    )
+
+    frigate_events = FrigateEvents(
+        app.logger,
+        frigate_proxy,
+        config["frigate_events_poll_interval"],
+        config["frigate_events_refresh_seconds"],
+        config["frigate_events_max_age_days"],
+        config["frigate_events_limit"],
+    )
+    frigate_events.start()
+    events_page_size = config["events_page_size"]
+
+    catalog = Catalog(app.logger, config["catalog_file"])
+
+    thumbnail_file_path = config["thumbnail_file_path"]
+    thumbnail_cache = ThumbnailCache(
+        app.logger,
+        image_storage,
+        thumbnail_file_path,
+        config["thumbnail_width"],
+        config["thumbnail_quality"],
+        config["thumbnail_format"],
+        config["thumbnail_cache_bytes"],
+        config["thumbnail_workers"],
+    )
+
+    file_manager = FileManager(
+        app.logger,
+        video_storage,
+        image_storage,
+        config["timelapse_video_file_path"],
+        config["timelapse_image_file_path"],
+        config["purge_video_days"],
+        config["purge_image_days"],
+        config["purge_timelapse_video_days"],
+        config["purge_timelapse_image_days"],
+        config["purge_batch_size"],
+        config["purge_batch_sleep"],
+        config["retention_mode"],
+        config["video_quota_bytes"],
+        config["image_quota_bytes"],
+        config["camera_video_quota_bytes"],
+        config["min_free_bytes"],
+        catalog,
+        thumbnail_cache,
+    )
+
+    snapshot_fetcher = SnapshotFetcher(
+        app.logger,
+        config["snapshot_workers"],
+        config["snapshot_connections_per_camera"],
+        config["snapshot_timeout"],
+        config["snapshot_retries"],
+        config["snapshot_backoff_seconds"],
+        config["snapshot_coalesce_seconds"],
+    )
+
     stream_cameras = {}
     capture_cameras = {}
+    segment_buffers = []
+    motion_detectors = []
     camera_display_names = {}
     timelapse_cameras = {}
 
-    i = 0
     for camera_config in config["cameras"]:
         camera_display_names[camera_config["name"]] = camera_config["display_name"]
         stream_cameras[camera_config["name"]] = StreamCamera(
@@ -385,20 +638,47 @@ if __name__ == "__main__":
             camera_config["stream"]["height"],
             camera_config["stream"]["restart_threshold"],
             camera_config["stream"]["compression"],
+            camera_config["stream"]["idle_timeout"],
+            config["profile_file_path"],
         )
 
-        capture_cameras[camera_config["name"]] = CaptureCamera(
+        _schedule_stream(stream_cameras[camera_config["name"]])
+
+        preroll_seconds = camera_config["capture"]["preroll_seconds"]
+        segment_buffer = SegmentBuffer(
             app.logger,
             camera_config["name"],
             _replace_secrets(secrets, camera_config["capture"]["url"]),
+            config["segment_buffer_path"],
+            camera_config["capture"]["segment_seconds"],
+            preroll_seconds + 2 * camera_config["capture"]["segment_seconds"],
+        )
+        segment_buffer.start()
+        segment_buffers.append(segment_buffer)
+
+        capture_cameras[camera_config["name"]] = CaptureCamera(
+            app.logger,
+            camera_config["name"],
             _replace_secrets(secrets, camera_config["capture"]["image_url"]),
             camera_config["capture"]["ffmpeg_options"],
-            config["video_file_path"],
-            config["image_file_path"],
+            video_storage,
+            image_storage,
             config["temp_video_file_path"],
             config["capture_timeout"],
+            file_manager,
+            segment_buffer,
+            preroll_seconds,
+            snapshot_fetcher,
+            _get_image_stream_camera(camera_config["name"], camera_config["capture"]),
+            camera_config["capture"]["image_width"],
+            camera_config["capture"]["image_quality"],
         )
 
+        if camera_config["motion"]["enabled"]:
+            motion_detector = create_motion_detector(app.logger, camera_config["name"], camera_config["motion"])
+            motion_detector.start(stream_cameras[camera_config["name"]], capture_cameras[camera_config["name"]])
+            motion_detectors.append(motion_detector)
+
         timelapse_camera = TimelapseCamera(
             app.logger,
             camera_config["name"],
@@ -407,24 +687,42 @@ if __name__ == "__main__":
             config["timelapse_video_file_path"],
             config["timelapse_image_file_path"],
             config["timelapse_hours"],
+            file_manager,
+            snapshot_fetcher,
+            _get_image_stream_camera(camera_config["name"], camera_config["timelapse"]),
+            camera_config["timelapse"]["image_width"],
+            camera_config["timelapse"]["image_quality"],
         )
 
         timelapse_cameras[camera_config["name"]] = timelapse_camera
 
-        _schedule(timelapse_camera, i)
-        i = i + 1
+        _schedule(timelapse_camera)
 
-    file_manager = FileManager(
+    timelapse_builder = TimelapseBuilder(
         app.logger,
-        config["video_file_path"],
-        config["image_file_path"],
-        config["purge_video_days"],
-        config["purge_image_days"],
+        timelapse_cameras,
+        config["timelapse_image_file_path"],
+        config["timelapse_build_workers"],
     )
+    schedule.every().day.at("00:01:00").do(timelapse_builder.build_async)
+
+    metrics.add_collector(_collect_metrics)
+
+    schedule.every(1).minutes.do(file_manager.reconcile)
+    schedule.every(config["purge_interval_minutes"]).minutes.do(file_manager.purge_async)
 
     schedule_thread = threading.Thread(
-        target=_run_schedule
+        target=_run_schedule,
+        daemon=True,
     )
     schedule_thread.start()
 
-    app.run(host="0.0.0.0")
+    max_stream_clients = config["server"]["max_stream_clients"]
+    internal_networks = [ipaddress.ip_network(network) for network in config["server"]["internal_networks"]]
+    snapshot_max_age = config["snapshot_max_age"]
+    profile_sample_interval = config["profile_sample_interval"]
+    profile_max_seconds = config["profile_max_seconds"]
+    route_timer = RouteTimer(app)
+    sampling_profiler = SamplingProfiler(app.logger)
+    started = int(time.time())
+    wsgi_server.serve(app, app.logger, config["server"], _shutdown)
@@ -0,0 +1,124 @@
+import os
+import sys
+import threading
+import time
+
+
+def _get_original(module_name, name):
+    if "gevent.monkey" in sys.modules:
+        from gevent import monkey
+
+        if monkey.is_module_patched(module_name):
+            return monkey.get_original(module_name, name)
+    return getattr(__import__(module_name), name)
+
+
+class RouteTimer(object):
+    def __init__(self, app):
+        self._app = app
+        self._wsgi_app = app.wsgi_app
+        self._timings = {}
+        self._lock = threading.Lock()
+        self._enabled_at = None
+
+    def enable(self):
+        if self._enabled_at is None:
+            self._enabled_at = time.time()
+            self._app.wsgi_app = self._timed_wsgi_app
+
+    def disable(self):
+        self._app.wsgi_app = self._wsgi_app
+        self._enabled_at = None
+
+    def reset(self):
+        with self._lock:
+            self._timings = {}
+
+    def get_stats(self):
+        with self._lock:
+            routes = [
+                {
+                    "endpoint": endpoint,
+                    "method": method,
+                    "count": count,
+                    "total_ms": round(1000 * total, 1),
+                    "mean_ms": round(1000 * total / count, 2),
+                    "max_ms": round(1000 * maximum, 2),
+                }
+                for (endpoint, method), (count, total, maximum) in self._timings.items()
+            ]
+        routes.sort(key=lambda route: route["total_ms"], reverse=True)
+        return {"enabled": self._enabled_at is not None, "enabled_at": self._enabled_at, "routes": routes}
+
+    def _timed_wsgi_app(self, environ, start_response):
+        start = time.perf_counter()
+        try:
+            return self._wsgi_app(environ, start_response)
+        finally:
+            elapsed = time.perf_counter() - start
+            try:
+                endpoint = self._app.url_map.bind_to_environ(environ).match()[0]
+            except Exception:
+                endpoint = "<unmatched>"
+            key = (endpoint, environ.get("REQUEST_METHOD"))
+            with self._lock:
+                count, total, maximum = self._timings.get(key, (0, 0.0, 0.0))
+                self._timings[key] = (count + 1, total + elapsed, max(maximum, elapsed))
+
+
+class SamplingProfiler(object):
+    def __init__(self, logger):
+        self._logger = logger
+        self._lock = threading.Lock()
+        self._running = False
+
+    def sample(self, seconds, interval):
+        with self._lock:
+            if self._running:
+                return None
+            self._running = True
+
+        self._logger.info(f"Sampling stacks for {seconds}s every {interval * 1000:.0f}ms")
+        result = []
+        _get_original("_thread", "start_new_thread")(self._sample, (seconds, interval, result))
+        try:
+            while len(result) == 0:
+                time.sleep(min(0.1, seconds))
+        finally:
+            with self._lock:
+                self._running = False
+
+        samples, stacks = result[0]
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        thread_names.setdefault(_get_original("_thread", "get_ident")(), "MainThread")
+        collapsed = {}
+        for (thread_id, stack), count in stacks.items():
+            key = ";".join((thread_names.get(thread_id, f"thread-{thread_id}"),) + stack)
+            collapsed[key] = collapsed.get(key, 0) + count
+        self._logger.info(f"Collected {samples} samples, {len(collapsed)} unique stacks")
+        return "".join([f"{stack} {count}\n" for stack, count in sorted(collapsed.items())])
+
+    def _sample(self, seconds, interval, result):
+        # Runs on a native thread so that it keeps sampling while greenlets hog the hub;
+        # it must not touch logging or other patched locks.
+        sleep = _get_original("time", "sleep")
+        own_thread = _get_original("_thread", "get_ident")()
+        stacks = {}
+        samples = 0
+        try:
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id == own_thread:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                        frame = frame.f_back
+                    key = (thread_id, tuple(reversed(stack)))
+                    stacks[key] = stacks.get(key, 0) + 1
+                samples = samples + 1
+                sleep(interval)
+        finally:
+            result.append((samples, stacks))
@@ -0,0 +1,186 @@
+from bisect import bisect_left, insort
+from datetime import datetime
+import threading
+from catalog import parse_image_filename, parse_video_filename
+
+
+_BULK_THRESHOLD = 1000
+
+
+def _parse_image_filename(filename):
+    parsed = parse_image_filename(filename)
+    if parsed is None:
+        return None
+    return parsed[0], parsed[2]
+
+
+class RecordingsIndex(object):
+    def __init__(self, logger, video_storage, image_storage):
+        self._logger = logger
+        self._video_storage = video_storage
+        self._image_storage = image_storage
+        self._lock = threading.RLock()
+
+        self._videos = {}
+        self._images = {}
+        self._video_files = []
+        self._orphan_image_files = []
+        self._video_shards = {}
+        self._image_shards = {}
+
+    def add_video(self, video_file):
+        with self._lock:
+            if self._insert_video(video_file):
+                insort(self._video_files, video_file)
+                for image_file in self._images.get(parse_video_filename(video_file), []):
+                    self._remove_sorted(self._orphan_image_files, image_file)
+
+    def remove_video(self, video_file):
+        key = parse_video_filename(video_file)
+        with self._lock:
+            if key is None or self._videos.get(key) != video_file:
+                return
+            del self._videos[key]
+            self._remove_sorted(self._video_files, video_file)
+            for image_file in self._images.get(key, []):
+                insort(self._orphan_image_files, image_file)
+
+    def add_image(self, image_file):
+        with self._lock:
+            if self._insert_image(image_file) and _parse_image_filename(image_file) not in self._videos:
+                insort(self._orphan_image_files, image_file)
+
+    def remove_image(self, image_file):
+        key = _parse_image_filename(image_file)
+        with self._lock:
+            if key is None or key not in self._images:
+                return
+            image_files = self._images[key]
+            if not self._remove_sorted(image_files, image_file):
+                return
+            if not image_files:
+                del self._images[key]
+            if key not in self._videos:
+                self._remove_sorted(self._orphan_image_files, image_file)
+
+    def get_mapped_recordings(self):
+        with self._lock:
+            recording_files = [
+                (video_file, list(self._images.get(parse_video_filename(video_file), [])))
+                for video_file in reversed(self._video_files)
+            ]
+            orphan_image_files = list(reversed(self._orphan_image_files))
+
+        recordings = []
+        for video_file, matching_image_files in recording_files:
+            timestamp, camera_name = parse_video_filename(video_file)
+
+            image_file = None
+            extra_images = []
+            for matching_image_file in matching_image_files:
+                if image_file is None:
+                    image_file = matching_image_file
+                else:
+                    extra_images.append({
+                        "timestamp": datetime.strptime(matching_image_file[16:31], "%Y%m%d_%H%M%S"),
+                        "filename": matching_image_file,
+                    })
+
+            recordings.append({
+                "camera_name": camera_name,
+                "timestamp": datetime.strptime(timestamp, "%Y%m%d_%H%M%S"),
+                "video_filename": video_file,
+                "image_filename": image_file,
+                "extra_images": extra_images,
+            })
+
+        orphan_images = []
+        for image_file in orphan_image_files:
+            orphan_images.append({
+                "camera_name": _parse_image_filename(image_file)[1],
+                "timestamp": datetime.strptime(image_file[16:31], "%Y%m%d_%H%M%S"),
+                "image_filename": image_file,
+            })
+
+        return recordings, orphan_images
+
+    def reconcile(self):
+        video_files = self._list_changed(self._video_storage, self._video_shards)
+        if video_files is not None:
+            with self._lock:
+                known = set(self._videos.values())
+            self._reconcile_files(known, video_files, ".mp4", self.add_video, self.remove_video)
+
+        image_files = self._list_changed(self._image_storage, self._image_shards)
+        if image_files is not None:
+            with self._lock:
+                known = set(image_file for image_files in self._images.values() for image_file in image_files)
+            self._reconcile_files(known, image_files, ".jpeg", self.add_image, self.remove_image)
+
+        return video_files, image_files
+
+    def _list_changed(self, storage, shards):
+        changed = len(shards) == 0
+        current = storage.get_shards()
+        for directory in list(shards):
+            if directory not in current:
+                del shards[directory]
+                changed = True
+        for directory, mtime in current.items():
+            if directory not in shards or shards[directory][0] != mtime:
+                shards[directory] = (mtime, storage.list_shard(directory))
+                changed = True
+        if not changed:
+            return None
+        return set().union(*[files for mtime, files in shards.values()])
+
+    def _reconcile_files(self, known, listed, extension, add, remove):
+        added = listed - known
+        removed = known - listed
+        if len(added) > _BULK_THRESHOLD:
+            insert = self._insert_video if extension == ".mp4" else self._insert_image
+            with self._lock:
+                for file in added:
+                    insert(file)
+                self._sort()
+        else:
+            for file in added:
+                add(file)
+        for file in removed:
+            remove(file)
+        if known and (added or removed):
+            self._logger.info(f"Reconciled recordings index: {len(added)} added, {len(removed)} removed {extension} files")
+
+    def _insert_video(self, video_file):
+        key = parse_video_filename(video_file)
+        if key is None or key in self._videos:
+            return False
+        self._videos[key] = video_file
+        return True
+
+    def _insert_image(self, image_file):
+        key = _parse_image_filename(image_file)
+        if key is None:
+            return False
+        image_files = self._images.setdefault(key, [])
+        index = bisect_left(image_files, image_file)
+        if index < len(image_files) and image_files[index] == image_file:
+            return False
+        image_files.insert(index, image_file)
+        return True
+
+    def _sort(self):
+        self._video_files = sorted(self._videos.values())
+        self._orphan_image_files = sorted(
+            image_file
+            for key, image_files in self._images.items()
+            if key not in self._videos
+            for image_file in image_files
+        )
+
+    def _remove_sorted(self, files, file):
+        index = bisect_left(files, file)
+        if index < len(files) and files[index] == file:
+            del files[index]
+            return True
+        return False
@@ -0,0 +1,129 @@
+from datetime import datetime, timezone
+import os
+import signal
+import subprocess
+import threading
+import time
+from metrics import metrics
+
+
+class SegmentBuffer(object):
+    def __init__(
+        self,
+        logger,
+        camera_name,
+        camera_url,
+        buffer_path,
+        segment_seconds,
+        buffer_seconds,
+    ):
+        self._logger = logger
+        self._camera_name = camera_name
+        self._camera_url = camera_url
+        self._segment_path = f"{buffer_path}{camera_name}/"
+        self._segment_seconds = segment_seconds
+        self._buffer_seconds = buffer_seconds
+
+        self._lock = threading.Lock()
+        self._holds = {}
+        self._next_hold_id = 0
+        self._process = None
+        self._running = False
+
+        os.makedirs(self._segment_path, exist_ok=True)
+        for file in os.listdir(self._segment_path):
+            os.remove(f"{self._segment_path}{file}")
+
+    def start(self):
+        self._running = True
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def close(self):
+        self._running = False
+        process = self._process
+        if process is not None:
+            try:
+                os.killpg(os.getpgid(process.pid), signal.SIGTERM)
+            except Exception:
+                pass
+
+    def hold(self, since):
+        with self._lock:
+            hold_id = self._next_hold_id
+            self._next_hold_id = self._next_hold_id + 1
+            self._holds[hold_id] = since
+            return hold_id
+
+    def release(self, hold_id):
+        with self._lock:
+            self._holds.pop(hold_id, None)
+
+    def get_segments(self, since, until):
+        return [
+            (start, end, file)
+            for start, end, file in self._list_segments()
+            if end > since and start < until
+        ]
+
+    def wait_for(self, until):
+        timeout = time.time() + 3 * self._segment_seconds + 5
+        while time.time() < timeout:
+            segments = self._list_segments()
+            if len(segments) > 0 and segments[-1][1] >= until:
+                return True
+            time.sleep(0.5)
+        self._logger.warning(f"Timed out waiting for segments for {self._camera_name}")
+        return False
+
+    def _list_segments(self):
+        files = list(filter(lambda x: x.endswith(".ts"), os.listdir(self._segment_path)))
+        files.sort()
+        segments = []
+        for i in range(len(files) - 1):
+            segments.append((
+                self._parse_timestamp(files[i]),
+                self._parse_timestamp(files[i + 1]),
+                f"{self._segment_path}{files[i]}",
+            ))
+        return segments
+
+    def _parse_timestamp(self, file):
+        return datetime.strptime(file[0:15], "%Y%m%d_%H%M%S").replace(tzinfo=timezone.utc).timestamp()
+
+    def _prune(self):
+        with self._lock:
+            keep_since = min([time.time() - self._buffer_seconds] + list(self._holds.values()))
+        for start, end, file in self._list_segments():
+            if end < keep_since:
+                try:
+                    os.remove(file)
+                except FileNotFoundError:
+                    pass
+
+    def _run(self):
+        rtsp_options = ""
+        if self._camera_url.startswith("rtsp"):
+            rtsp_options = "-rtsp_transport tcp"
+        command = f'ffmpeg -loglevel warning -nostats -y {rtsp_options} -i "{self._camera_url}" -map 0 -c copy -f segment -segment_time {self._segment_seconds} -segment_format mpegts -reset_timestamps 1 -strftime 1 "{self._segment_path}%Y%m%d_%H%M%S.ts"'
+        while self._running:
+            self._logger.info(f"Launching segment buffer process for {self._camera_name}")
+            start = time.time()
+            self._process = subprocess.Popen(
+                command,
+                shell=True,
+                env=dict(os.environ, TZ="UTC"),
+                preexec_fn=os.setsid,
+            )
+            while self._process.poll() is None:
+                self._prune()
+                time.sleep(self._segment_seconds)
+            elapsed = time.time() - start
+            labels = {"camera": self._camera_name, "job": "segment"}
+            metrics.observe("nvr_ffmpeg_seconds", labels, elapsed)
+            metrics.inc("nvr_ffmpeg_exits_total", dict(labels, code=self._process.returncode))
+            self._logger.warning(
+                f"Segment buffer process for {self._camera_name} exited with {self._process.returncode} after {elapsed:.1f}s"
+            )
+            self._process = None
+            if self._running:
+                time.sleep(5)
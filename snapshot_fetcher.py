@@ -0,0 +1,160 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import random
+import ssl
+import threading
+import time
+import urllib.parse
+from http_pool import HTTPConnectionPool
+from metrics import metrics
+
+
+class SnapshotFetcher(object):
+    def __init__(
+        self,
+        logger,
+        workers,
+        connections_per_camera,
+        timeout,
+        retries,
+        backoff_seconds,
+        coalesce_seconds,
+    ):
+        self._logger = logger
+        self._connections_per_camera = connections_per_camera
+        self._timeout = timeout
+        self._retries = retries
+        self._backoff_seconds = backoff_seconds
+        self._coalesce_seconds = coalesce_seconds
+
+        self._ssl_context = ssl.create_default_context()
+        self._ssl_context.check_hostname = False
+        self._ssl_context.verify_mode = ssl.CERT_NONE
+
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="snapshot")
+        self._lock = threading.Lock()
+        self._pools = {}
+        self._pending = {}
+        self._last_start = {}
+
+    def fetch(self, camera_name, url, filename, callback=None, stream_camera=None, width=None, quality=None):
+        with self._lock:
+            pending = self._pending.get(url)
+            if pending is not None:
+                self._logger.info(f"Coalescing snapshot for {camera_name} into queued fetch")
+                metrics.inc("nvr_snapshot_coalesced_total", {"camera": camera_name})
+                pending["targets"].append((filename, callback))
+                return
+            request = {
+                "targets": [(filename, callback)],
+                "stream_camera": stream_camera,
+                "width": width,
+                "quality": quality,
+            }
+            self._pending[url] = request
+            delay = 0
+            last_start = self._last_start.get(url)
+            if last_start is not None:
+                delay = last_start + self._coalesce_seconds - time.time()
+        if delay > 0:
+            self._logger.info(f"Delaying snapshot for {camera_name} by {delay:.1f}s to coalesce requests")
+            timer = threading.Timer(delay, self._submit, args=(camera_name, url, request))
+            timer.daemon = True
+            timer.start()
+        else:
+            self._submit(camera_name, url, request)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    def _submit(self, camera_name, url, request):
+        try:
+            self._executor.submit(self._run, camera_name, url, request)
+        except RuntimeError as err:
+            self._logger.warning(f"Dropping snapshot for {camera_name}: {err}")
+
+    def _get_pool(self, url):
+        key = (url.scheme, url.netloc)
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = HTTPConnectionPool(
+                    f"{url.scheme}://{url.netloc}",
+                    self._connections_per_camera,
+                    self._timeout,
+                    self._ssl_context,
+                )
+                self._pools[key] = pool
+            return pool
+
+    def _run(self, camera_name, url, request):
+        with self._lock:
+            del self._pending[url]
+            self._last_start[url] = time.time()
+        try:
+            self._take_snapshot(camera_name, url, request)
+        except Exception as err:
+            self._logger.error(f"Snapshot for {camera_name} failed: {err}")
+            metrics.inc("nvr_snapshot_failures_total", {"camera": camera_name})
+
+    def _take_snapshot(self, camera_name, url, request):
+        start = time.time()
+        source = "stream"
+        data = None
+        if request["stream_camera"] is not None:
+            try:
+                data = request["stream_camera"].get_snapshot(request["width"], request["quality"])
+            except Exception as err:
+                self._logger.warning(f"Failed to take snapshot from stream for {camera_name}: {err}")
+        if data is None:
+            source = "camera"
+            data = self._fetch(camera_name, url)
+            if data is None:
+                return
+        for filename, callback in request["targets"]:
+            temp_filename = f"{filename}.tmp"
+            with open(temp_filename, "wb") as f:
+                f.write(data)
+            os.rename(temp_filename, filename)
+        elapsed = time.time() - start
+        metrics.observe("nvr_snapshot_seconds", {"camera": camera_name, "source": source}, elapsed)
+        self._logger.info(
+            f"Fetched snapshot from {source} for {camera_name} in {elapsed:.2f}s, "
+            f"written to {len(request['targets'])} files"
+        )
+        for filename, callback in request["targets"]:
+            if callback is not None:
+                try:
+                    callback(filename)
+                except Exception as err:
+                    self._logger.error(f"Snapshot callback failed for {camera_name}: {err}")
+
+    def _fetch(self, camera_name, url):
+        split_url = urllib.parse.urlsplit(url)
+        pool = self._get_pool(split_url)
+        path = split_url.path
+        if split_url.query:
+            path = f"{path}?{split_url.query}"
+
+        for i in range(self._retries + 1):
+            try:
+                connection, response = pool.request("GET", path)
+                try:
+                    data = response.read()
+                finally:
+                    pool.release(connection, response)
+                if response.status != 200:
+                    raise Exception(f"HTTP {response.status}")
+                return data
+            except Exception as err:
+                if i < self._retries:
+                    sleep = self._backoff_seconds * (2 ** i) * random.uniform(0.5, 1.5)
+                    self._logger.warning(
+                        f"Failed to fetch snapshot for {camera_name}, retrying after {sleep:.1f}s: {err}"
+                    )
+                    metrics.inc("nvr_snapshot_retries_total", {"camera": camera_name})
+                    time.sleep(sleep)
+                else:
+                    self._logger.error(f"Failed to fetch snapshot for {camera_name}: {err}")
+                    metrics.inc("nvr_snapshot_failures_total", {"camera": camera_name})
+        return None
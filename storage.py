@@ -0,0 +1,171 @@
+import json
+import logging
+import os
+import shutil
+import sys
+from catalog import parse_image_filename, parse_video_filename
+
+
+_LAYOUTS = ["flat", "sharded"]
+
+
+class Storage(object):
+    def __init__(self, logger, file_path, layout, parse_filename):
+        if layout not in _LAYOUTS:
+            raise Exception(f"Unknown storage layout {layout}, expected one of {_LAYOUTS}")
+        self._logger = logger
+        self._file_path = file_path
+        self._layout = layout
+        self._parse_filename = parse_filename
+
+    def get_root(self):
+        return self._file_path
+
+    def get_directory(self, filename):
+        if self._layout == "flat":
+            return self._file_path
+        if os.path.basename(filename) != filename:
+            return None
+        parsed = self._parse_filename(filename)
+        if parsed is None or parsed[-1].startswith("."):
+            return None
+        return f"{self._file_path}{parsed[-1]}/{filename[0:4]}/{filename[4:6]}/{filename[6:8]}/"
+
+    def get_path(self, filename):
+        directory = self.get_directory(filename)
+        if directory is None:
+            return None
+        return f"{directory}{filename}"
+
+    def prepare_path(self, filename):
+        directory = self.get_directory(filename)
+        os.makedirs(directory, exist_ok=True)
+        return f"{directory}{filename}"
+
+    def get_shards(self, camera_name=None):
+        if self._layout == "flat":
+            return {self._file_path: os.stat(self._file_path).st_mtime_ns}
+        shards = {}
+        camera_names = [camera_name] if camera_name is not None else _list_directories(self._file_path)
+        for camera in camera_names:
+            for year in _list_directories(f"{self._file_path}{camera}/"):
+                for month in _list_directories(f"{self._file_path}{camera}/{year}/"):
+                    for day in _list_directories(f"{self._file_path}{camera}/{year}/{month}/"):
+                        directory = f"{self._file_path}{camera}/{year}/{month}/{day}/"
+                        try:
+                            shards[directory] = os.stat(directory).st_mtime_ns
+                        except FileNotFoundError:
+                            pass
+        return shards
+
+    def list_shard(self, directory):
+        try:
+            return set(filter(lambda x: self._parse_filename(x) is not None, os.listdir(directory)))
+        except FileNotFoundError:
+            return set()
+
+    def list_files(self):
+        files = set()
+        for directory in self.get_shards():
+            files.update(self.list_shard(directory))
+        return files
+
+    def get_latest_file(self, endswith, camera_name=None):
+        shards_by_date = {}
+        for directory in self.get_shards(camera_name):
+            shards_by_date.setdefault(directory[-11:], []).append(directory)
+        for date in sorted(shards_by_date, reverse=True):
+            files = [
+                file
+                for directory in shards_by_date[date]
+                for file in self.list_shard(directory)
+                if file.endswith(endswith)
+            ]
+            if len(files) > 0:
+                return max(files)
+        return None
+
+    def get_shards_before(self, date):
+        if self._layout == "flat":
+            return []
+        return sorted(
+            directory for directory in self.get_shards() if directory[-11:-1].replace("/", "") < date
+        )
+
+    def remove_shard(self, directory):
+        files = []
+        for file in self.list_shard(directory):
+            try:
+                files.append((file, os.path.getsize(f"{directory}{file}")))
+            except FileNotFoundError:
+                pass
+        shutil.rmtree(directory, ignore_errors=True)
+        self._remove_empty_parents(os.path.dirname(directory.rstrip("/")))
+        return files
+
+    def remove(self, filename):
+        file = self.get_path(filename)
+        try:
+            os.remove(file)
+        except FileNotFoundError:
+            self._logger.warning(f"File {file} already removed")
+            return False
+        if self._layout == "sharded":
+            self._remove_empty_parents(os.path.dirname(file))
+        return True
+
+    def _remove_empty_parents(self, directory):
+        directory = directory.rstrip("/")
+        while len(directory) + 1 > len(self._file_path):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                return
+            directory = os.path.dirname(directory)
+
+
+def _list_directories(path):
+    try:
+        return sorted(entry.name for entry in os.scandir(path) if entry.is_dir() and not entry.name.startswith("."))
+    except FileNotFoundError:
+        return []
+
+
+def migrate(logger, file_path, layout, parse_filename):
+    target = Storage(logger, file_path, layout, parse_filename)
+    moved = 0
+    for directory, directories, files in os.walk(file_path):
+        directory = f"{directory.rstrip('/')}/"
+        for file in files:
+            if parse_filename(file) is None:
+                continue
+            target_file = target.get_path(file)
+            if target_file is None or target_file == f"{directory}{file}":
+                continue
+            if os.path.exists(target_file):
+                logger.warning(f"Skipping {directory}{file}, {target_file} already exists")
+                continue
+            os.makedirs(os.path.dirname(target_file), exist_ok=True)
+            os.rename(f"{directory}{file}", target_file)
+            moved = moved + 1
+    for directory, directories, files in os.walk(file_path, topdown=False):
+        if f"{directory.rstrip('/')}/" != file_path and len(os.listdir(directory)) == 0:
+            os.rmdir(directory)
+    logger.info(f"Moved {moved} files in {file_path} to the {layout} layout")
+    return moved
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s in %(module)s: %(message)s")
+    logger = logging.getLogger(__name__)
+
+    if len(sys.argv) < 3 or sys.argv[1] != "migrate" or sys.argv[2] not in _LAYOUTS:
+        print(f"Usage: {sys.argv[0]} migrate <{'|'.join(_LAYOUTS)}>")
+        print("Stop the server first and set storage_layout in config.json to match afterwards.")
+        sys.exit(1)
+
+    with open("config.json", "r") as f:
+        config = json.load(f)
+
+    migrate(logger, config["video_file_path"], sys.argv[2], parse_video_filename)
+    migrate(logger, config["image_file_path"], sys.argv[2], parse_image_filename)
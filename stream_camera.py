@@ -1,5 +1,5 @@
-from queue import Empty
 import threading
+from collections import OrderedDict
 import cv2
 import time
 import numpy
@@ -9,6 +9,16 @@ from datetime import datetime
 import logging
 import sys
 from datetime import timezone
+from frame_buffer import SharedFrameBuffer
+from metrics import metrics
+from profiler import SamplingProfiler
+import wsgi_server
+
+
+_SNAPSHOT_MAX_AGE = 2
+_VIEWER_TIMEOUT = 10
+_MIN_PROFILE_WIDTH = 80
+_LATEST_JPEG_PROFILES = 16
 
 
 class StreamCamera(object):
@@ -22,77 +32,315 @@ class StreamCamera(object):
         height,
         restart_threshold,
         compression,
+        idle_timeout,
+        profile_file_path,
     ):
         self._logger = logger
+        self._camera_name = camera_name
+        self._camera_url = camera_url
         self._frame_sleep = frame_sleep
+        self._width = width
+        self._height = height
+        self._restart_threshold = restart_threshold
         self._compression = compression
+        self._idle_timeout = idle_timeout
+        self._profile_file_path = profile_file_path
+        os.makedirs(self._profile_file_path, exist_ok=True)
 
-        self._return_frame_queue = multiprocessing.Queue()
-        self._request_frame_queue = multiprocessing.Queue()
-
-        self._streaming_process = multiprocessing.Process(
-            target=self._stream,
-            args=(
-                camera_name,
-                camera_url,
-                frame_sleep,
-                width,
-                height,
-                restart_threshold,
-                self._return_frame_queue,
-                self._request_frame_queue
-            ),
-        )
-        self._streaming_process.start()
-
-    def get_jpeg(self):
-        frame = self.get_frame()
-        return bytearray(cv2.imencode(".jpeg", frame, [cv2.IMWRITE_JPEG_QUALITY, self._compression])[1])
-
-    def get_frame(self):
-        time.sleep(self._frame_sleep)
-        frame = None
-        try:
-            if not self._return_frame_queue.empty():
-                frame = self._return_frame_queue.get_nowait()
-        except Empty:
-            pass
+        self._profiles = {}
+        self._jpeg_condition = threading.Condition()
+        self._latest_jpegs = OrderedDict()
+        self._latest_jpeg_lock = threading.Lock()
+        self._viewers = 0
+        self._broadcast_thread = None
+
+        self._frame_buffer = SharedFrameBuffer(width, height)
+
+        self._process_lock = threading.Lock()
+        self._streaming_process = None
+        self._last_active = time.monotonic()
+        self._decode_started = None
+        self._decode_seconds = 0.0
+        self._metrics_frames = 0
+        self._metrics_time = time.monotonic()
+        self._profile_lock = threading.Lock()
+
+        if not self._idle_timeout:
+            self._start_streaming()
+
+    def _start_streaming(self):
+        with self._process_lock:
+            self._last_active = time.monotonic()
+            if self._streaming_process is not None and self._streaming_process.is_alive():
+                return
+            self._logger.info(f"Starting stream process for {self._camera_name}")
+            self._frame_buffer.publish(_create_text_image(self._width, self._height, "Startar"), live=False)
+            self._streaming_process = multiprocessing.get_context("spawn").Process(
+                target=_stream,
+                args=(
+                    self._camera_name,
+                    self._camera_url,
+                    self._frame_sleep,
+                    self._width,
+                    self._height,
+                    self._restart_threshold,
+                    self._frame_buffer,
+                    self._profile_file_path,
+                ),
+                daemon=True,
+            )
+            self._streaming_process.start()
+            self._decode_started = time.monotonic()
+
+    def _stop_streaming(self):
+        with self._process_lock:
+            if self._streaming_process is None:
+                return
+            self._logger.info(f"Stopping stream process for {self._camera_name}")
+            self._streaming_process.terminate()
+            self._streaming_process.join(5)
+            self._streaming_process = None
+            self._decode_seconds = self._decode_seconds + time.monotonic() - self._decode_started
+            self._decode_started = None
+
+    def close(self):
+        self._stop_streaming()
+        self._frame_buffer.close()
+
+    def touch(self):
+        self._start_streaming()
+
+    def stop_if_idle(self):
+        if not self._idle_timeout:
+            return
+        with self._jpeg_condition:
+            if self._viewers > 0:
+                return
+        if time.monotonic() - self._last_active > self._idle_timeout:
+            self._stop_streaming()
+
+    def get_viewers(self):
+        with self._jpeg_condition:
+            return self._viewers
+
+    def get_stats(self):
+        with self._process_lock:
+            decode_uptime = self._decode_seconds
+            if self._decode_started is not None:
+                decode_uptime = decode_uptime + time.monotonic() - self._decode_started
+            streaming = self._streaming_process is not None
+        with self._jpeg_condition:
+            profiles = [
+                {"width": width, "quality": quality, "viewers": stream_profile["viewers"]}
+                for (width, quality), stream_profile in self._profiles.items()
+            ]
+        return {
+            "viewers": self._viewers,
+            "streaming": streaming,
+            "decode_uptime": round(decode_uptime, 1),
+            "profiles": profiles,
+        }
+
+    def collect_metrics(self):
+        labels = {"camera": self._camera_name}
+        counters = self._frame_buffer.get_counters()
+        now = time.monotonic()
+        fps = (counters["frames"] - self._metrics_frames) / max(now - self._metrics_time, 0.001)
+        self._metrics_frames = counters["frames"]
+        self._metrics_time = now
+        metrics.set("nvr_stream_clients", labels, self._viewers)
+        metrics.set("nvr_stream_decoding", labels, 1 if self._streaming_process is not None else 0)
+        metrics.set("nvr_stream_decode_fps", labels, round(fps, 2))
+        metrics.set("nvr_stream_frames_total", labels, counters["frames"])
+        metrics.set("nvr_stream_grab_failures_total", labels, counters["grab_failures"])
+        metrics.set("nvr_stream_restarts_total", labels, counters["restarts"])
+
+    def profile(self, seconds, interval):
+        with self._profile_lock:
+            self.touch()
+            profile_file = f"{self._profile_file_path}{self._camera_name}.collapsed"
+            if os.path.exists(profile_file):
+                os.remove(profile_file)
+            self._frame_buffer.request_profile(seconds, interval)
+            deadline = time.monotonic() + seconds + 10
+            while time.monotonic() < deadline:
+                if os.path.exists(profile_file):
+                    with open(profile_file, "r") as f:
+                        return f.read()
+                time.sleep(0.2)
+            self._frame_buffer.take_profile_request()
+            self._logger.warning(f"Stream process for {self._camera_name} did not return a profile")
+            return None
+
+    def get_profile(self, width=None, quality=None):
+        if width is None:
+            width = self._width
+        width = max(_MIN_PROFILE_WIDTH, min(self._width, width - width % 8))
+        if quality is None:
+            quality = self._compression
+        quality = max(10, min(95, quality))
+        return width, quality
+
+    def get_max_fps(self):
+        return 1 / self._frame_sleep
+
+    def is_live(self):
+        return self._frame_buffer.is_live()
+
+    def get_snapshot(self, width, quality):
+        self.touch()
+        if not self._frame_buffer.is_live() or self._frame_buffer.get_age() > max(_SNAPSHOT_MAX_AGE, 10 * self._frame_sleep):
+            return None
+        sequence, frame = self._frame_buffer.read()
         if frame is None:
-            self._request_frame_queue.put(True)
-            frame = self._return_frame_queue.get()
-        return frame
+            return None
+        if width is not None:
+            frame = self._resize(frame, width)
+        return self._encode(frame, quality)
 
-    def _stream(
-        self,
+    def get_latest_jpeg(self, profile):
+        self.touch()
+        with self._latest_jpeg_lock:
+            cached = self._latest_jpegs.get(profile)
+            if cached is not None and cached[0] == self._frame_buffer.get_sequence():
+                self._latest_jpegs.move_to_end(profile)
+                return cached
+            sequence, frame = self._frame_buffer.read()
+            if frame is None:
+                return 0, None
+            width, quality = profile
+            cached = (sequence, self._encode(self._resize(frame, width), quality))
+            self._latest_jpegs[profile] = cached
+            self._latest_jpegs.move_to_end(profile)
+            while len(self._latest_jpegs) > _LATEST_JPEG_PROFILES:
+                self._latest_jpegs.popitem(last=False)
+            return cached
+
+    def open_viewer(self, profile):
+        self._start_streaming()
+        with self._jpeg_condition:
+            self._viewers = self._viewers + 1
+            if profile not in self._profiles:
+                self._profiles[profile] = {"jpeg": None, "sequence": 0, "viewers": 0, "waiting": 0}
+            self._profiles[profile]["viewers"] = self._profiles[profile]["viewers"] + 1
+            if self._broadcast_thread is None:
+                self._logger.info(f"Starting broadcast for {self._camera_name}")
+                self._broadcast_thread = threading.Thread(target=self._broadcast, daemon=True)
+                self._broadcast_thread.start()
+
+    def close_viewer(self, profile):
+        with self._jpeg_condition:
+            self._viewers = self._viewers - 1
+            self._profiles[profile]["viewers"] = self._profiles[profile]["viewers"] - 1
+            if self._profiles[profile]["viewers"] <= 0:
+                del self._profiles[profile]
+        self._last_active = time.monotonic()
+
+    def wait_jpeg(self, profile, sequence):
+        timeout = max(_VIEWER_TIMEOUT, 10 * self._frame_sleep)
+        with self._jpeg_condition:
+            stream_profile = self._profiles[profile]
+            stream_profile["waiting"] = stream_profile["waiting"] + 1
+            try:
+                ready = self._jpeg_condition.wait_for(
+                    lambda: stream_profile["jpeg"] is not None and stream_profile["sequence"] > sequence, timeout
+                )
+            finally:
+                stream_profile["waiting"] = stream_profile["waiting"] - 1
+            if ready:
+                return stream_profile["sequence"], stream_profile["jpeg"]
+        self._logger.info(f"No new frame for {self._camera_name} in {timeout}s, closing viewer")
+        return sequence, None
+
+    def _broadcast(self):
+        frame_sequence = 0
+        while True:
+            with self._jpeg_condition:
+                if self._viewers <= 0:
+                    self._logger.info(f"Stopping broadcast for {self._camera_name}")
+                    self._broadcast_thread = None
+                    return
+            sequence, frame = self.wait_frame(frame_sequence, 1)
+            if frame is None:
+                continue
+            frame_sequence = sequence
+            metrics.observe("nvr_stream_frame_wait_seconds", {"camera": self._camera_name}, self._frame_buffer.get_age())
+
+            with self._jpeg_condition:
+                profiles = [
+                    profile
+                    for profile, stream_profile in self._profiles.items()
+                    if stream_profile["waiting"] > 0 or stream_profile["jpeg"] is None
+                ]
+            resized = {}
+            jpegs = {}
+            for width, quality in profiles:
+                if width not in resized:
+                    resized[width] = self._resize(frame, width)
+                jpegs[(width, quality)] = self._encode(resized[width], quality)
+
+            with self._jpeg_condition:
+                for profile, jpeg in jpegs.items():
+                    if profile in self._profiles:
+                        self._profiles[profile]["jpeg"] = jpeg
+                        self._profiles[profile]["sequence"] = self._profiles[profile]["sequence"] + 1
+                self._jpeg_condition.notify_all()
+
+    def _resize(self, frame, width):
+        if width == frame.shape[1]:
+            return frame
+        return wsgi_server.offload(
+            lambda: cv2.resize(frame, (width, int(frame.shape[0] * width / frame.shape[1])), interpolation=cv2.INTER_AREA)
+        )
+
+    def _encode(self, frame, quality):
+        start = time.perf_counter()
+        jpeg = wsgi_server.offload(lambda: bytes(cv2.imencode(".jpeg", frame, [cv2.IMWRITE_JPEG_QUALITY, quality])[1]))
+        metrics.observe("nvr_stream_encode_seconds", {"camera": self._camera_name}, time.perf_counter() - start)
+        return jpeg
+
+    def wait_frame(self, sequence, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            if self._frame_buffer.get_sequence() != sequence:
+                latest_sequence, frame = self._frame_buffer.read()
+                if frame is not None:
+                    return latest_sequence, frame
+            if time.monotonic() >= deadline:
+                return sequence, None
+            time.sleep(self._frame_sleep / 4)
+
+def _stream(
+    camera_name,
+    camera_url,
+    frame_sleep,
+    width,
+    height,
+    restart_threshold,
+    frame_buffer,
+    profile_file_path,
+):
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.INFO)
+    default_handler = logging.StreamHandler(sys.stdout)
+    default_handler.setFormatter(
+        logging.Formatter("[%(asctime)s] %(levelname)s in %(module)s: %(message)s")
+    )
+    logger.addHandler(default_handler)
+    camera = _InternalStreamCamera(
+        logger,
         camera_name,
         camera_url,
         frame_sleep,
         width,
         height,
         restart_threshold,
-        return_frame_queue,
-        request_frame_queue,
-    ):
-        logger = logging.getLogger(__name__)
-        logger.setLevel(logging.INFO)
-        default_handler = logging.StreamHandler(sys.stdout)
-        default_handler.setFormatter(
-            logging.Formatter("[%(asctime)s] %(levelname)s in %(module)s: %(message)s")
-        )
-        logger.addHandler(default_handler)
-        camera = _InternalStreamCamera(
-            logger,
-            camera_name,
-            camera_url,
-            frame_sleep,
-            width,
-            height,
-            restart_threshold,
-            return_frame_queue,
-            request_frame_queue,
-        )
-        os.nice(10)
-        camera.stream()
+        frame_buffer,
+        profile_file_path,
+    )
+    os.nice(10)
+    camera.stream()
+
 
 class _InternalStreamCamera(object):
     def __init__(
@@ -104,8 +352,8 @@ class _InternalStreamCamera(object):
         width,
         height,
         restart_threshold,
-        return_frame_queue,
-        request_frame_queue,
+        frame_buffer,
+        profile_file_path,
     ):
         self._logger = logger
         self._camera_name = camera_name
@@ -114,13 +362,15 @@ class _InternalStreamCamera(object):
         self._width = width
         self._height = height
         self._restart_threshold = restart_threshold
-        self._return_frame_queue = return_frame_queue
-        self._request_frame_queue = request_frame_queue
+        self._frame_buffer = frame_buffer
+        self._profile_file_path = profile_file_path
 
         self._streaming = False
         self._loading = False
         self._last_init_timestamp = None
         self._static_frame = None
+        self._published_static_frame = None
+        self._last_publish_time = 0
         self._frame_count = 0
     
     def _get_frame(self):
@@ -135,6 +385,7 @@ class _InternalStreamCamera(object):
         self._logger.info(f"Initializing camera stream for {self._camera_name}")
         self._video_capture = cv2.VideoCapture(self._camera_url)
         self._logger.info(f"Started camera stream for {self._camera_name}")
+        self._frame_buffer.count_restart()
         self._streaming = True
         self._loading = False
         self._frame_count = 0
@@ -156,6 +407,7 @@ class _InternalStreamCamera(object):
 
                 if not success:
                     self._logger.warning(f"Failed to grab frame for {self._camera_name}")
+                    self._frame_buffer.count_grab_failure()
                     self._static_frame = self._create_fail_image()
                     self._streaming = False
                     self._video_capture.release()
@@ -163,15 +415,15 @@ class _InternalStreamCamera(object):
                 else:
                     self._static_frame = None
                     self._frame_count = self._frame_count + 1
+                    self._frame_buffer.count_frame()
             else:
                 time.sleep(self._frame_sleep)
             
-            frame = None
-            while not self._request_frame_queue.empty():
-                if frame is None:
-                    frame = self._get_frame()
-                self._return_frame_queue.put(frame)
-                self._request_frame_queue.get_nowait()
+            self._publish_frame()
+
+            profile_request = self._frame_buffer.take_profile_request()
+            if profile_request is not None:
+                threading.Thread(target=self._profile, args=profile_request, daemon=True).start()
 
             if self._streaming and self._frame_count > self._restart_threshold:
                 self._logger.info(f"Reloading stream for {self._camera_name}")
@@ -179,49 +431,51 @@ class _InternalStreamCamera(object):
                 self._video_capture.release()
                 self._video_capture = None
 
-    def _empty_queue(self):
-        try:
-            while not self._return_frame_queue.empty():
-                self._return_frame_queue.get_nowait()
-        except Empty:
-            pass
+    def _profile(self, seconds, interval):
+        collapsed = SamplingProfiler(self._logger).sample(seconds, interval)
+        profile_file = f"{self._profile_file_path}{self._camera_name}.collapsed"
+        with open(f"{profile_file}.tmp", "w") as f:
+            f.write(collapsed)
+        os.rename(f"{profile_file}.tmp", profile_file)
 
-    def _create_loading_image(self):
-        img = numpy.zeros((self._height, self._width, 3), numpy.uint8)
-        font = cv2.FONT_HERSHEY_SIMPLEX
-        bottom_left_corner_of_text = (int(self._width / 2) - 80, int(self._height / 2))
-        font_scale = 1
-        font_color = (255, 255, 255)
-        line_type = 2
-
-        cv2.putText(
-            img,
-            f"Startar",
-            bottom_left_corner_of_text,
-            font,
-            font_scale,
-            font_color,
-            line_type,
-        )
+    def _publish_frame(self):
+        if self._static_frame is not None:
+            if self._static_frame is not self._published_static_frame:
+                self._frame_buffer.publish(self._static_frame, live=False)
+                self._published_static_frame = self._static_frame
+            return
+        self._published_static_frame = None
+        now = time.monotonic()
+        if now - self._last_publish_time < self._frame_sleep:
+            return
+        frame = self._get_frame()
+        if frame is not None:
+            self._frame_buffer.publish(frame)
+            self._last_publish_time = now
 
-        return img
+    def _create_loading_image(self):
+        return _create_text_image(self._width, self._height, "Startar")
 
     def _create_fail_image(self):
-        img = numpy.zeros((self._height, self._width, 3), numpy.uint8)
-        font = cv2.FONT_HERSHEY_SIMPLEX
-        bottom_left_corner_of_text = (int(self._width / 2) - 80, int(self._height / 2))
-        font_scale = 1
-        font_color = (255, 255, 255)
-        line_type = 2
-
-        cv2.putText(
-            img,
-            f"Kamerafel",
-            bottom_left_corner_of_text,
-            font,
-            font_scale,
-            font_color,
-            line_type,
-        )
+        return _create_text_image(self._width, self._height, "Kamerafel")
+
+
+def _create_text_image(width, height, text):
+    img = numpy.zeros((height, width, 3), numpy.uint8)
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    bottom_left_corner_of_text = (int(width / 2) - 80, int(height / 2))
+    font_scale = 1
+    font_color = (255, 255, 255)
+    line_type = 2
+
+    cv2.putText(
+        img,
+        text,
+        bottom_left_corner_of_text,
+        font,
+        font_scale,
+        font_color,
+        line_type,
+    )
 
-        return img
+    return img
@@ -0,0 +1,159 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from flask import Flask, request
+import logging
+import tempfile
+import threading
+import unittest
+from frigate_proxy import FrigateProxy
+
+
+_CLIP = bytes(range(256)) * 64
+_ETAG = '"clip-1"'
+_snapshot_versions = []
+
+
+class _FrigateHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self._respond(True)
+
+    def do_HEAD(self):
+        self._respond(False)
+
+    def _respond(self, send_body):
+        if self.path.endswith("/snapshot.jpg"):
+            _snapshot_versions.append(self.path)
+            body = f"snapshot {len(_snapshot_versions)}".encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if send_body:
+                self.wfile.write(body)
+            return
+        if not self.path.endswith("/clip.mp4"):
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if self.headers.get("If-None-Match") == _ETAG:
+            self.send_response(304)
+            self.send_header("ETag", _ETAG)
+            self.end_headers()
+            return
+        body = _CLIP
+        status = 200
+        range_header = self.headers.get("Range")
+        if range_header is not None:
+            start, end = [int(value) for value in range_header[len("bytes="):].split("-")]
+            body = _CLIP[start:end + 1]
+            status = 206
+        self.send_response(status)
+        self.send_header("Content-Type", "video/mp4")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", _ETAG)
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(_CLIP)}")
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FrigateProxyTest(unittest.TestCase):
+    def setUp(self):
+        _snapshot_versions.clear()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _FrigateHandler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        self._cache_directory = tempfile.TemporaryDirectory()
+
+        self._proxy = FrigateProxy(
+            logging.getLogger(__name__),
+            f"http://127.0.0.1:{self._server.server_address[1]}",
+            2,
+            2,
+            1024,
+            f"{self._cache_directory.name}/snapshots/",
+            1024 * 1024,
+        )
+        app = Flask(__name__)
+
+        @app.route("/clips/<path:event_id>")
+        def get_clips(event_id):
+            return self._proxy.get_clip(event_id, request.headers, request.method)
+
+        @app.route("/snapshots/<path:event_id>")
+        def get_snapshots(event_id):
+            return self._proxy.get_snapshot(event_id, request.headers, request.method, event_id == "ended")
+
+        self._client = app.test_client()
+
+    def tearDown(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._cache_directory.cleanup()
+
+    def test_get(self):
+        for i in range(5):
+            with self._client.get("/clips/x") as response:
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.get_data(), _CLIP)
+                self.assertEqual(response.headers["ETag"], _ETAG)
+
+    def test_range(self):
+        for i in range(5):
+            with self._client.get("/clips/x", headers={"Range": "bytes=100-199"}) as response:
+                self.assertEqual(response.status_code, 206)
+                self.assertEqual(response.get_data(), _CLIP[100:200])
+                self.assertEqual(response.headers["Content-Range"], f"bytes 100-199/{len(_CLIP)}")
+
+    def test_not_modified_releases_connection(self):
+        for i in range(5):
+            with self._client.get("/clips/x", headers={"If-None-Match": _ETAG}) as response:
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(response.get_data(), b"")
+        with self._client.get("/clips/x") as response:
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.get_data(), _CLIP)
+
+    def test_head_releases_connection(self):
+        for i in range(5):
+            with self._client.head("/clips/x") as response:
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.headers["Content-Length"], str(len(_CLIP)))
+        with self._client.get("/clips/x") as response:
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.get_data(), _CLIP)
+
+    def test_unread_body_releases_connection(self):
+        for i in range(5):
+            response = self._client.get("/clips/x")
+            self.assertEqual(response.status_code, 200)
+            response.close()
+        with self._client.get("/clips/x") as response:
+            self.assertEqual(response.get_data(), _CLIP)
+
+    def test_in_progress_snapshot_is_not_cached(self):
+        for i in range(1, 3):
+            with self._client.get("/snapshots/running") as response:
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.get_data(), f"snapshot {i}".encode())
+
+    def test_ended_snapshot_is_cached_and_revalidated(self):
+        with self._client.get("/snapshots/ended") as response:
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.get_data(), b"snapshot 1")
+            etag = response.headers["ETag"]
+        with self._client.get("/snapshots/ended") as response:
+            self.assertEqual(response.get_data(), b"snapshot 1")
+        with self._client.get("/snapshots/ended", headers={"If-None-Match": etag}) as response:
+            self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(_snapshot_versions), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
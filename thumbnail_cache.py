@@ -0,0 +1,156 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import os
+import threading
+import wsgi_server
+
+
+class ThumbnailCache(object):
+    def __init__(
+        self,
+        logger,
+        image_storage,
+        thumbnail_file_path,
+        width,
+        quality,
+        format,
+        max_bytes,
+        workers,
+    ):
+        self._logger = logger
+        self._image_storage = image_storage
+        self._thumbnail_file_path = thumbnail_file_path
+        self._width = width
+        self._quality = quality
+        self._format = format
+        self._max_bytes = max_bytes
+
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="thumbnail")
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._pending = {}
+
+        self._load()
+
+    def _load(self):
+        os.makedirs(self._thumbnail_file_path, exist_ok=True)
+        entries = []
+        for file in os.listdir(self._thumbnail_file_path):
+            if file.startswith("."):
+                self._remove_file(file)
+                continue
+            try:
+                stat = os.stat(f"{self._thumbnail_file_path}{file}")
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, file, stat.st_size))
+        entries.sort()
+        for mtime, file, size in entries:
+            self._entries[file] = size
+            self._total_bytes = self._total_bytes + size
+        self._evict()
+
+    def get_mimetype(self):
+        return f"image/{self._format}"
+
+    def get_etag(self, image_file):
+        return f"{self.get_thumbnail_file(image_file)}-{self._quality}"
+
+    def get_thumbnail_file(self, image_file):
+        return f"{os.path.splitext(image_file)[0]}_{self._width}.{self._format}"
+
+    def warm(self, image_file):
+        self._submit(image_file)
+
+    def get(self, image_file):
+        if os.path.basename(image_file) != image_file:
+            return None
+        thumbnail_file = self.get_thumbnail_file(image_file)
+        with self._lock:
+            if thumbnail_file in self._entries:
+                self._entries.move_to_end(thumbnail_file)
+                return thumbnail_file
+        return self._submit(image_file).result()
+
+    def remove(self, image_file):
+        thumbnail_file = self.get_thumbnail_file(image_file)
+        with self._lock:
+            size = self._entries.pop(thumbnail_file, None)
+            if size is None:
+                return
+            self._total_bytes = self._total_bytes - size
+        self._remove_file(thumbnail_file)
+
+    def _submit(self, image_file):
+        with self._lock:
+            future = self._pending.get(image_file)
+            if future is None:
+                future = self._executor.submit(self._generate, image_file)
+                self._pending[image_file] = future
+            return future
+
+    def _generate(self, image_file):
+        try:
+            thumbnail_file = self.get_thumbnail_file(image_file)
+            with self._lock:
+                if thumbnail_file in self._entries:
+                    return thumbnail_file
+
+            image_path = self._image_storage.get_path(image_file)
+            size = None
+            if image_path is not None:
+                size = wsgi_server.offload(self._create_thumbnail, image_path, thumbnail_file)
+            if size is None:
+                self._logger.warning(f"Failed to read image {image_file} for thumbnail")
+                return None
+
+            with self._lock:
+                self._entries[thumbnail_file] = size
+                self._total_bytes = self._total_bytes + size
+            self._evict()
+            return thumbnail_file
+        except Exception as err:
+            self._logger.error(f"Failed to create thumbnail for {image_file}: {err}")
+            return None
+        finally:
+            with self._lock:
+                self._pending.pop(image_file, None)
+
+    def _create_thumbnail(self, image_path, thumbnail_file):
+        image = cv2.imread(image_path)
+        if image is None:
+            return None
+        height, width = image.shape[0:2]
+        if width > self._width:
+            image = cv2.resize(
+                image, (self._width, int(height * self._width / width)), interpolation=cv2.INTER_AREA
+            )
+        if self._format == "webp":
+            params = [cv2.IMWRITE_WEBP_QUALITY, self._quality]
+        else:
+            params = [cv2.IMWRITE_JPEG_QUALITY, self._quality]
+        data = cv2.imencode(f".{self._format}", image, params)[1].tobytes()
+
+        temp_file = f"{self._thumbnail_file_path}.{thumbnail_file}.tmp"
+        with open(temp_file, "wb") as f:
+            f.write(data)
+        os.replace(temp_file, f"{self._thumbnail_file_path}{thumbnail_file}")
+        return len(data)
+
+    def _evict(self):
+        evicted = []
+        with self._lock:
+            while self._total_bytes > self._max_bytes and len(self._entries) > 0:
+                thumbnail_file, size = self._entries.popitem(last=False)
+                self._total_bytes = self._total_bytes - size
+                evicted.append(thumbnail_file)
+        for thumbnail_file in evicted:
+            self._remove_file(thumbnail_file)
+
+    def _remove_file(self, thumbnail_file):
+        try:
+            os.remove(f"{self._thumbnail_file_path}{thumbnail_file}")
+        except FileNotFoundError:
+            pass
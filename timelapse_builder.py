@@ -0,0 +1,89 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from datetime import timezone
+import os
+import threading
+import time
+from metrics import metrics
+
+
+class TimelapseBuilder(object):
+    def __init__(self, logger, timelapse_cameras, image_file_path, workers):
+        self._logger = logger
+        self._timelapse_cameras = timelapse_cameras
+        self._image_file_path = image_file_path
+        self._workers = workers
+
+        self._build_thread = None
+
+    def build_async(self):
+        if self._build_thread is not None and self._build_thread.is_alive():
+            self._logger.warning("Timelapse build already running, skipping")
+            return
+        self._build_thread = threading.Thread(target=self.build, daemon=True)
+        self._build_thread.start()
+
+    def build(self):
+        start = time.time()
+        year = (datetime.now(tz=timezone.utc) - timedelta(days=1)).strftime("%Y")
+        old_year = (datetime.now(tz=timezone.utc) - timedelta(days=2)).strftime("%Y")
+
+        scan_start = time.time()
+        slots = self._scan()
+        metrics.observe("nvr_file_scan_seconds", {"kind": "timelapse"}, time.time() - scan_start)
+        jobs = []
+        # Each slot spends its time waiting on ffmpeg subprocesses, so threads are
+        # enough to run them in parallel and avoid pickling the cameras.
+        with ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="timelapse") as executor:
+            for camera_name, timelapse_camera in self._timelapse_cameras.items():
+                for hour in range(0, 24):
+                    padded_hour = f"{hour:02}"
+                    if len(slots.get((old_year, padded_hour, camera_name), [])) == 0:
+                        continue
+                    old_images = []
+                    if year != old_year:
+                        old_images = slots[(old_year, padded_hour, camera_name)]
+                    jobs.append((
+                        f"{year}_{padded_hour}_{camera_name}",
+                        executor.submit(
+                            self._build_slot,
+                            timelapse_camera,
+                            year,
+                            padded_hour,
+                            slots.get((year, padded_hour, camera_name), []),
+                            old_images,
+                        ),
+                    ))
+
+        timings = []
+        for slot, job in jobs:
+            try:
+                timings.append((job.result(), slot))
+            except Exception as err:
+                self._logger.error(f"Timelapse build for {slot} failed: {err}")
+        timings.sort(reverse=True)
+        for elapsed, slot in timings:
+            self._logger.info(f"Timelapse slot {slot} built in {elapsed:.1f}s")
+        elapsed = time.time() - start
+        self._logger.info(
+            f"Built {len(jobs)} timelapse slots with {self._workers} workers in {elapsed:.1f}s "
+            f"(sum of slot times {sum([slot_elapsed for slot_elapsed, slot in timings]):.1f}s)"
+        )
+
+    def _build_slot(self, timelapse_camera, year, padded_hour, images, old_images):
+        start = time.time()
+        timelapse_camera.build_slot(year, padded_hour, images, old_images)
+        return time.time() - start
+
+    def _scan(self):
+        slots = {}
+        for file in os.listdir(self._image_file_path):
+            if not file.endswith(".jpeg") or len(file) < 25:
+                continue
+            key = (file[0:4], file[16:18], file[19:-5])
+            if key not in slots:
+                slots[key] = []
+            slots[key].append(file)
+        for images in slots.values():
+            images.sort()
+        return slots
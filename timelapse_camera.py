@@ -1,13 +1,17 @@
-from datetime import datetime, timedelta
+from datetime import datetime
 import time
-import threading
-from os import listdir
-import subprocess, io
+import subprocess
 import os
 import psutil
-import utils
+import hashlib
+import json
+from metrics import metrics
 from datetime import timezone
 
+
+_FRAMERATE = 7
+
+
 class TimelapseCamera(object):
     def __init__(
         self,
@@ -18,6 +22,11 @@ class TimelapseCamera(object):
         video_file_path,
         image_file_path,
         hours,
+        file_manager,
+        snapshot_fetcher,
+        stream_camera,
+        image_width,
+        image_quality,
     ):
         self._logger = logger
         self._camera_name = camera_name
@@ -25,16 +34,19 @@ class TimelapseCamera(object):
         self._ffmpeg_options = ffmpeg_options
         self._video_file_path = video_file_path
         self._image_file_path = image_file_path
+        self._build_file_path = f"{video_file_path}incremental/"
         self._hours = hours
+        self._file_manager = file_manager
+        self._snapshot_fetcher = snapshot_fetcher
+        self._stream_camera = stream_camera
+        self._image_width = image_width
+        self._image_quality = image_quality
 
-        self._capture_image_thread = None
+        os.makedirs(self._build_file_path, exist_ok=True)
 
     def capture_image_async(self):
         self._logger.info(f"Triggered timelapse for {self._camera_name}")
-        self._capture_image_thread = threading.Thread(
-            target=self._capture_image
-        )
-        self._capture_image_thread.start()
+        self._capture_image()
 
     def _capture_image(self):
         hour = int(datetime.now(tz=timezone.utc).strftime("%H"))
@@ -48,10 +60,15 @@ class TimelapseCamera(object):
 
         timestamp = datetime.now(tz=timezone.utc).strftime("%Y%m%d_%H%M%S")
         filename = f"{timestamp}_{padded_hour}_{self._camera_name}"
-        start = time.time()
-        utils.urlopen_to_file(self._logger, self._camera_image_url, f"{self._image_file_path}{filename}.jpeg", 4)
-        elapsed = time.time() - start
-        self._logger.info(f"Capture timelapse image done for {self._camera_name} in {elapsed:.1f}s")
+        self._snapshot_fetcher.fetch(
+            self._camera_name,
+            self._camera_image_url,
+            f"{self._image_file_path}{filename}.jpeg",
+            None,
+            self._stream_camera,
+            self._image_width,
+            self._image_quality,
+        )
 
     def _preexec_fn(self):
         try:
@@ -62,39 +79,111 @@ class TimelapseCamera(object):
         except Exception as err:
             self._logger.error(f"Failed execute preexec_fn: {err}")
         
-    def _build_video(self, year, padded_hour):
+    def _build_video(self, year, padded_hour, images):
         start = time.time()
-        command = f'ffmpeg -loglevel error -nostats -y -framerate 7 -pattern_type  glob -i "{self._image_file_path}{year}*_{padded_hour}_{self._camera_name}.jpeg" -metadata title="" {self._ffmpeg_options} {self._video_file_path}{year}_{padded_hour}_{self._camera_name}.mp4'
+        filename = f"{year}_{padded_hour}_{self._camera_name}.mp4"
+        video_file = f"{self._video_file_path}{filename}"
+        if len(images) == 0:
+            return
+
+        options_hash = hashlib.sha1(f"{_FRAMERATE} {self._ffmpeg_options}".encode()).hexdigest()
+        manifest_file = f"{self._build_file_path}{os.path.splitext(filename)[0]}.json"
+        manifest = None
+        if os.path.isfile(manifest_file) and os.path.isfile(video_file):
+            with open(manifest_file, "r") as f:
+                manifest = json.load(f)
+
+        built = False
+        if manifest is not None and manifest["options"] == options_hash:
+            new_images = [image for image in images if image > manifest["last_image"]]
+            if len(new_images) == 0:
+                self._logger.info(f"Timelapse video {filename} is up to date")
+                return
+            self._logger.info(f"Appending {len(new_images)} images to timelapse video {filename}")
+            built = self._append_video(filename, new_images)
+        if not built:
+            self._logger.info(f"Rebuilding timelapse video {filename} from {len(images)} images")
+            temp_file = f"{self._build_file_path}{filename}.tmp"
+            built = self._encode(images, temp_file)
+            if built:
+                os.rename(temp_file, video_file)
+
+        elapsed = time.time() - start
+        self._logger.info(
+            f"Timelapse video build for {self._camera_name} done in {elapsed:.1f}s"
+        )
+        if built:
+            with open(manifest_file, "w") as f:
+                json.dump({"options": options_hash, "last_image": images[-1]}, f)
+            self._file_manager.add_timelapse(filename)
+
+    def _append_video(self, filename, images):
+        prefix = f"{self._build_file_path}{os.path.splitext(filename)[0]}"
+        segment_file = f"{prefix}_segment.tmp"
+        list_file = f"{prefix}_concat.txt"
+        concat_file = f"{prefix}_concat.tmp"
+        try:
+            if not self._encode(images, segment_file):
+                return False
+            with open(list_file, "w") as f:
+                f.write(f"file '{os.path.abspath(f'{self._video_file_path}{filename}')}'\n")
+                f.write(f"file '{os.path.abspath(segment_file)}'\n")
+            if not self._run(f'ffmpeg -loglevel error -nostats -y -f concat -safe 0 -i {list_file} -c copy -metadata title="" -f mp4 {concat_file}'):
+                return False
+            os.rename(concat_file, f"{self._video_file_path}{filename}")
+            return True
+        finally:
+            for file in [segment_file, list_file, concat_file]:
+                if os.path.isfile(file):
+                    os.remove(file)
+
+    def _encode(self, images, output_file):
+        return self._run(
+            f'ffmpeg -loglevel error -nostats -y -framerate {_FRAMERATE} -f image2pipe -c:v mjpeg -i - -metadata title="" {self._ffmpeg_options} -f mp4 {output_file}',
+            images,
+        )
+
+    def _run(self, command, images=[]):
         self._logger.info(
             f"Launching timelapse video build process for {self._camera_name}: {command}"
         )
+        start = time.time()
         build_video_process = subprocess.Popen(
             command,
             shell=True,
-            stdout=subprocess.PIPE,
-            bufsize=-1,
+            stdin=subprocess.PIPE,
             preexec_fn=self._preexec_fn,
         )
-        output = io.TextIOWrapper(build_video_process.stdout)
+        fed = True
+        try:
+            for image in images:
+                with open(f"{self._image_file_path}{image}", "rb") as f:
+                    build_video_process.stdin.write(f.read())
+        except Exception as err:
+            self._logger.error(f"Failed to feed timelapse images for {self._camera_name}: {err}")
+            fed = False
+            build_video_process.kill()
+        finally:
+            try:
+                build_video_process.stdin.close()
+            except BrokenPipeError:
+                pass
         build_video_process.wait()
-        output
-        elapsed = time.time() - start
-        self._logger.info(
-            f"Timelapse video build process for {self._camera_name} done in {elapsed:.1f}s"
-        )
-
-    def build_videos(self):
-        year = (datetime.now(tz=timezone.utc) - timedelta(days=1)).strftime("%Y")
-        old_year = (datetime.now(tz=timezone.utc) - timedelta(days=2)).strftime("%Y")
-
-        for hour in range(0, 23):
-            padded_hour = f'{hour:02}'
-            files = list(
-                filter(lambda x: (x.startswith(old_year) and x.endswith(f"_{padded_hour}_{self._camera_name}.jpeg")), listdir(self._image_file_path))
+        if not fed:
+            return False
+        labels = {"camera": self._camera_name, "job": "timelapse"}
+        metrics.observe("nvr_ffmpeg_seconds", labels, time.time() - start)
+        metrics.inc("nvr_ffmpeg_exits_total", dict(labels, code=build_video_process.returncode))
+        if build_video_process.returncode != 0:
+            self._logger.error(
+                f"Timelapse video build process for {self._camera_name} failed with {build_video_process.returncode}"
             )
-            if len(files) > 0:
-                self._build_video(year, padded_hour)
+            return False
+        return True
+
+    def build_slot(self, year, padded_hour, images, old_images):
+        self._build_video(year, padded_hour, images)
 
-                if year != old_year and os.path.isfile(f"{self._video_file_path}{year}_{padded_hour}_{self._camera_name}.mp4"):
-                    for file in files:
-                        os.remove(f"{self._image_file_path}/{file}")
+        if len(old_images) > 0 and os.path.isfile(f"{self._video_file_path}{year}_{padded_hour}_{self._camera_name}.mp4"):
+            for file in old_images:
+                os.remove(f"{self._image_file_path}{file}")
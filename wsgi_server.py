@@ -0,0 +1,68 @@
+import json
+import signal
+import sys
+
+
+_threadpool = None
+
+
+def prepare(config_file="config.json"):
+    global _threadpool
+    with open(config_file, "r") as f:
+        server_config = json.load(f)["server"]
+    if server_config["mode"] == "gevent":
+        import gevent
+        from gevent import monkey
+
+        monkey.patch_all()
+        _threadpool = gevent.get_hub().threadpool
+        _threadpool.maxsize = server_config["native_threads"]
+
+
+def offload(func, *args):
+    # With gevent, threading workers are greenlets, so CPU-bound and blocking native calls
+    # (cv2, numpy, sqlite) run on the hub's native threadpool instead of stalling every
+    # connection. func must not log or touch locks, conditions or queues.
+    if _threadpool is None:
+        return func(*args)
+    return _threadpool.apply(func, args)
+
+
+def serve(app, logger, server_config, on_shutdown):
+    try:
+        if server_config["mode"] == "gevent":
+            _serve_gevent(app, logger, server_config)
+        else:
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+            app.run(host=server_config["host"], port=server_config["port"], threaded=True)
+    finally:
+        logger.info("Shutting down")
+        on_shutdown()
+
+
+def _serve_gevent(app, logger, server_config):
+    import gevent
+    from gevent.pool import Pool
+    from gevent.pywsgi import WSGIServer
+
+    server = WSGIServer(
+        (server_config["host"], server_config["port"]),
+        app,
+        spawn=Pool(server_config["max_connections"]),
+        log=None,
+        error_log=logger,
+        environ={"wsgi.errors": sys.stderr},
+    )
+
+    def stop():
+        logger.info(f"Stopping server, waiting up to {server_config['shutdown_timeout']}s for open requests")
+        server.stop(timeout=server_config["shutdown_timeout"])
+
+    gevent.signal_handler(signal.SIGTERM, stop)
+    gevent.signal_handler(signal.SIGINT, stop)
+
+    logger.info(
+        f"Serving on {server_config['host']}:{server_config['port']} with gevent, "
+        f"max {server_config['max_connections']} connections"
+    )
+    server.serve_forever()